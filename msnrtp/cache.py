@@ -0,0 +1,326 @@
+'''
+In memory caches for remote call results, and a reply cache shared by
+worker processes.
+'''
+import collections
+import fcntl
+import hashlib
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+
+# Returned by LRUCache.get for keys not in the cache, None is a valid value.
+MISSING = object()
+
+
+class LRUCache(object):
+    '''
+    A thread safe mapping holding at most max_size entries. Entries expire
+    ttl seconds after they were stored, a ttl of None keeps them until they
+    are evicted. When the cache is full the least recently used entry is
+    evicted.
+
+    With max_bytes set the cache also evicts entries once the sizes given to
+    put add up to more than max_bytes.
+    '''
+
+    def __init__(self, max_size=1024, ttl=None, max_bytes=None,
+                 clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Return the value stored for key, or MISSING.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                return MISSING
+            expires, value, size = entry
+            if expires is not None and expires <= self.clock():
+                self.size -= size
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return MISSING
+            # Re-inserting moves the key to the most recently used end
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value, size=0):
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (expires, value, size)
+            self.size += size
+            while self._entries and (
+                    len(self._entries) > self.max_size or
+                    self.max_bytes is not None and self.size > self.max_bytes):
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.stats['evictions'] += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+class SingleFlight(object):
+    '''
+    Collapse concurrent calls for the same key into one. The first caller
+    for a key runs the function, callers arriving while it runs wait for and
+    share its result or exception.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                self.stats['calls'] += 1
+                leader = True
+            else:
+                self.stats['shared'] += 1
+                leader = False
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._done(key)
+            future.set_exception(e)
+            raise
+        self._done(key)
+        future.set_result(result)
+        return result
+
+    def _done(self, key):
+        with self._lock:
+            del self._calls[key]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+# Slot header: seqlock version, used flag, referenced bit, key digest,
+# expiry time (0 for none) and value length.
+_SLOT = struct.Struct('<IBB2x20sdI')
+_REFERENCED_OFFSET = 5
+# Clock hands follow the slots, one per set, keyed by the set's first slot.
+_HAND = struct.Struct('<I')
+
+
+class SharedCache(object):
+    '''
+    A bytes to bytes cache in shared memory, usable from several processes.
+
+    The memory is an anonymous mapping inherited by processes forked after
+    the cache is created, or with path set a file mapped by every process
+    opening the same path. Memory is split into slots of slot_size bytes,
+    values larger than a slot are not cached. A key hashes to a set of ways
+    consecutive slots, when a set is full one of its slots is evicted with
+    the clock algorithm: slots read since the hand last passed get a second
+    chance. Each set's hand is kept in the shared memory and moves on from
+    the slot it last evicted.
+
+    Writers take a lock shared between the processes, readers take no lock.
+    With path set the lock is a flock, which does not exclude threads sharing
+    the file descriptor, so writers in one process also take a thread lock.
+    A slot's version is odd while it is written and is checked again after
+    copying the value, readers treat a slot changing under them as a miss.
+    Hits are copied out of the shared memory, a view would not be stable
+    while another process reuses the slot.
+    '''
+
+    def __init__(self, slots=1024, slot_size=8192, ttl=None, ways=8, path=None,
+                 clock=time.time):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.ways = min(ways, slots)
+        self.clock = clock
+        self.path = path
+        self.max_value = slot_size - _SLOT.size
+        self._hands = slots * slot_size
+        size = self._hands + slots * _HAND.size
+        if path is None:
+            self._fd = None
+            self._mutex = multiprocessing.Lock()
+            self.memory = mmap.mmap(-1, size)
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._mutex = threading.Lock()
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self.memory = mmap.mmap(self._fd, size)
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'too_large': 0}
+
+    def _lock(self):
+        self._mutex.acquire()
+        if self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                self._mutex.release()
+                raise
+
+    def _unlock(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mutex.release()
+
+    def _ways(self, digest):
+        first = struct.unpack_from('<Q', digest)[0] % self.slots
+        for n in range(self.ways):
+            yield ((first + n) % self.slots) * self.slot_size
+
+    def get(self, key):
+        '''
+        Return the value stored for key, or MISSING.
+        '''
+        digest = hashlib.sha1(key).digest()
+        memory = self.memory
+        for offset in self._ways(digest):
+            version, used, referenced, slot_digest, expires, length = \
+                _SLOT.unpack_from(memory, offset)
+            if version & 1 or not used or slot_digest != digest:
+                continue
+            if expires and expires <= self.clock():
+                break
+            start = offset + _SLOT.size
+            value = memory[start:start + length]
+            if _SLOT.unpack_from(memory, offset)[0] != version:
+                break
+            if not referenced:
+                memory[offset + _REFERENCED_OFFSET] = b'\x01'
+            self.stats['hits'] += 1
+            return value
+        self.stats['misses'] += 1
+        return MISSING
+
+    def put(self, key, value, size=0):
+        '''
+        Store a string or a list of buffers joined into one string.
+        '''
+        if isinstance(value, list):
+            value = b''.join(value)
+        if len(value) > self.max_value:
+            self.stats['too_large'] += 1
+            return
+        digest = hashlib.sha1(key).digest()
+        expires = 0
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+        self._lock()
+        try:
+            offset = self._find_slot(digest)
+            version = _SLOT.unpack_from(self.memory, offset)[0]
+            _SLOT.pack_into(self.memory, offset, version + 1, 0, 0, b'', 0, 0)
+            start = offset + _SLOT.size
+            self.memory[start:start + len(value)] = value
+            _SLOT.pack_into(
+                self.memory, offset, version + 2, 1, 0, digest, expires,
+                len(value)
+            )
+        finally:
+            self._unlock()
+
+    def _find_slot(self, digest):
+        # The slot already holding the key, else a free or expired slot,
+        # else the clock victim. Called with the lock held.
+        now = self.clock()
+        free = None
+        ways = list(self._ways(digest))
+        for offset in ways:
+            version, used, referenced, slot_digest, expires, length = \
+                _SLOT.unpack_from(self.memory, offset)
+            if used and slot_digest == digest:
+                return offset
+            if free is None and (not used or expires and expires <= now):
+                free = offset
+        if free is not None:
+            return free
+        self.stats['evictions'] += 1
+        hand_offset = self._hands + ways[0] // self.slot_size * _HAND.size
+        hand = _HAND.unpack_from(self.memory, hand_offset)[0] % len(ways)
+        while True:
+            offset = ways[hand]
+            hand = (hand + 1) % len(ways)
+            if self.memory[offset + _REFERENCED_OFFSET] == b'\x00':
+                _HAND.pack_into(self.memory, hand_offset, hand)
+                return offset
+            self.memory[offset + _REFERENCED_OFFSET] = b'\x00'
+
+    def invalidate(self, key):
+        digest = hashlib.sha1(key).digest()
+        self._lock()
+        try:
+            for offset in self._ways(digest):
+                version, used, referenced, slot_digest, expires, length = \
+                    _SLOT.unpack_from(self.memory, offset)
+                if used and slot_digest == digest:
+                    _SLOT.pack_into(
+                        self.memory, offset, version + 2, 0, 0, b'', 0, 0
+                    )
+        finally:
+            self._unlock()
+
+    def clear(self):
+        self._lock()
+        try:
+            for n in range(self.slots):
+                offset = n * self.slot_size
+                version = _SLOT.unpack_from(self.memory, offset)[0]
+                _SLOT.pack_into(self.memory, offset, version + 2, 0, 0, b'', 0, 0)
+        finally:
+            self._unlock()
+
+    def get_stats(self):
+        '''
+        Counters of this process.
+        '''
+        return dict(self.stats)
+
+    def close(self):
+        self.memory.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
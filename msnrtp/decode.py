@@ -0,0 +1,211 @@
+'''
+Decode remoting messages into plain python values.
+
+The grammar objects produced by RemotingMessage.unpack hold on to their
+MessageContext and every record they were built from. That is what we want
+when re-packing a message, but it makes them expensive to keep around and to
+pickle. The helpers here flatten a message into tuples, lists and dicts so
+results can be shipped between processes cheaply.
+'''
+import collections
+import itertools
+import multiprocessing
+import struct
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from msnrtp import SingleMessage, RequestUriHeader, peek_frame
+from msnrbf.records import (
+    BinaryObjectString, BinaryMethodCall, MemberPrimitiveTyped
+)
+from msnrbf.types import PrimitiveType, Datetime
+from msnrbf.scanner import project
+from msnrbf.grammar import (
+    RemotingMessage, MemberRef, Referenceable, MemberPrimitiveUnTyped,
+    Classes, Arrays, NullObject, StreamError
+)
+
+
+# The MS-NRTP protocol id as it appears on the wire
+FRAME_MAGIC = struct.pack('<i', SingleMessage.protocol_id)
+
+
+DecodedMessage = collections.namedtuple(
+    'DecodedMessage', [
+        'operation_type',
+        'uri',
+        'type_name',
+        'method_name',
+        'args',
+        'return_value',
+        'exception',
+    ]
+)
+
+
+DecodedObject = collections.namedtuple(
+    'DecodedObject', ['class_name', 'library_name', 'members']
+)
+
+
+def _resolve(node):
+    'Strip reference wrappers until we reach a record or grammar node'
+    while isinstance(node, (MemberRef, Referenceable)):
+        node = node.record
+    return node
+
+
+def _primitive(value):
+    if isinstance(value, Datetime):
+        return value
+    if isinstance(value, PrimitiveType):
+        return value._to_py()
+    return value
+
+
+def materialize(node, _memo=None):
+    '''
+    Convert a grammar node into plain python values. Classes become
+    DecodedObject tuples and arrays become lists. Object graphs with cycles
+    are supported, the same DecodedObject is returned for every reference to
+    a class record.
+    '''
+    if _memo is None:
+        _memo = {}
+    node = _resolve(node)
+    if node is None or isinstance(node, NullObject):
+        return None
+    if isinstance(node, BinaryObjectString):
+        return node.value
+    if isinstance(node, (MemberPrimitiveUnTyped, MemberPrimitiveTyped)):
+        return _primitive(node.value)
+    if id(node) in _memo:
+        return _memo[id(node)]
+    if isinstance(node, Classes):
+        members = collections.OrderedDict()
+        obj = DecodedObject(node.class_name, node.library_name, members)
+        _memo[id(node)] = obj
+        for name, ref in zip(node.class_info.member_names, node.refs):
+            members[name] = materialize(ref, _memo)
+        return obj
+    if isinstance(node, Arrays):
+        values = []
+        _memo[id(node)] = values
+        for ref in node.refs:
+            values.append(materialize(ref, _memo))
+        return values
+    raise StreamError("Unable to materialize {}".format(node))
+
+
+def materialize_message(rm, operation_type=None, uri=None):
+    '''
+    Build a DecodedMessage from an unpacked RemotingMessage.
+    '''
+    memo = {}
+    type_name = method_name = None
+    args = return_value = exception = None
+    method = rm.method
+    enum = method.message_enum
+    array = []
+    if method.array:
+        array = [materialize(ref, memo) for ref in method.array.refs]
+    if isinstance(method.method, BinaryMethodCall):
+        type_name = method.method.type_name
+        method_name = method.method.method_name
+        if enum.ArgsInline and method.method.args:
+            args = [val.value for val in method.method.args.values]
+        elif enum.ArgsIsArray:
+            # Each argument is an item of the call array
+            args = array
+        elif enum.ArgsInArray:
+            # The argument array is the first item of the call array
+            args = array[0]
+        else:
+            args = []
+    elif enum.ExceptionInArray:
+        exception = array[0]
+    elif enum.ReturnValueInArray:
+        return_value = array[0]
+    return DecodedMessage(
+        operation_type, uri, type_name, method_name, args, return_value,
+        exception
+    )
+
+
+def decode_message(byts):
+    '''
+    Decode a single message. Accepts either a complete MS-NRTP frame or a bare
+    MS-NRBF message body.
+    '''
+    operation_type = uri = None
+    if byts[:4] == FRAME_MAGIC:
+        msg = SingleMessage.unpack(byts)
+        operation_type = msg.operation_type
+        for header in msg.headers:
+            if isinstance(header, RequestUriHeader):
+                uri = header.uri
+        byts = msg.message
+    rm = RemotingMessage.unpack(byts)
+    return materialize_message(rm, operation_type, uri)
+
+
+def project_message(byts, paths):
+    '''
+    Extract the members at paths from a message without decoding the rest
+    of it, see msnrbf.scanner.project. Accepts either a complete MS-NRTP
+    frame or a bare MS-NRBF message body.
+    '''
+    offset = 0
+    if byts[:4] == FRAME_MAGIC:
+        offset = peek_frame(byts).body_offset
+    return project(byts, paths, offset)
+
+
+def _decode_chunk(chunk):
+    return [decode_message(byts) for byts in chunk]
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def decode_many(messages, workers=None, ordered=True, chunksize=64):
+    '''
+    Decode an iterable of messages across a pool of worker processes,
+    yielding DecodedMessage tuples.
+
+    Messages are sent to the workers in chunks of chunksize to amortize the
+    cost of pickling. No more than two chunks per worker are in flight at a
+    time so arbitrarily long iterables can be consumed without buffering them
+    in memory. When ordered is False results are yielded as soon as their
+    chunk completes. A workers value of 0 decodes in the calling process.
+    '''
+    if workers == 0:
+        for chunk in _chunked(messages, chunksize):
+            for result in _decode_chunk(chunk):
+                yield result
+        return
+    workers = workers or multiprocessing.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        window = workers * 2
+        pending = collections.deque()
+        for chunk in _chunked(messages, chunksize):
+            pending.append(executor.submit(_decode_chunk, chunk))
+            while len(pending) >= window:
+                for result in _next_done(pending, ordered):
+                    yield result
+        while pending:
+            for result in _next_done(pending, ordered):
+                yield result
+
+
+def _next_done(pending, ordered):
+    if ordered:
+        return pending.popleft().result()
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    future = done.pop()
+    pending.remove(future)
+    return future.result()
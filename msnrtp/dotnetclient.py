@@ -1,11 +1,18 @@
 import binascii
+import collections
+import contextlib
+import os
 import struct
 import socket
+import threading
 import select
 import time
 import packetview
 import logging
 import urlparse
+from netio import RecvBuffer, closed_by_peer
+from cache import MISSING, SingleFlight
+from decode import decode_message
 
 from msnrtp import *
 from msnrbf import *
@@ -32,44 +39,529 @@ def address(urlstr):
 
 
 class BasicClient(object):
+    '''
+    A blocking client for one connection.
 
-    def __init__(self, host, port):
+    Connecting, sending and receiving are bounded by the deadline started
+    with set_deadline, call starts a new deadline of timeout seconds for
+    each request and raises TimeoutException once it has passed. bytes_sent
+    counts the bytes written to all of the client's connections.
+    '''
+
+    def __init__(self, host, port, timeout=None):
         self.host = host
         self.port = port
+        self.timeout = timeout
+        self.deadline = None
+        self.connected = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.buffer = RecvBuffer()
+        self.bytes_sent = 0
+
+    def reset(self):
+        '''
+        Close the connection, the next call connects again.
+        '''
+        self.sock.close()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.buffer = RecvBuffer()
+        self.connected = False
+
+    def closed_by_peer(self):
+        '''
+        True when an idle connection was closed by the server.
+        '''
+        if not self.connected:
+            return False
+        return closed_by_peer(self.sock)
+
+    def set_deadline(self, timeout):
+        '''
+        Start a deadline timeout seconds from now, a timeout of None removes
+        the deadline.
+        '''
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout
+
+    def remaining(self):
+        '''
+        Seconds left until the deadline, None when there is no deadline.
+        '''
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutException
+        return remaining
 
     def connect(self):
-        self.sock.connect((self.host, self.port))
+        self.sock.settimeout(self.remaining())
+        try:
+            self.sock.connect((self.host, self.port))
+        except socket.timeout:
+            raise TimeoutException
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock.setblocking(0)
+        self.connected = True
+
+    def call(self, msg, timeout=None):
+        '''
+        Send a request and return the reply, connecting first if needed.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        self.set_deadline(timeout)
+        try:
+            if not self.connected:
+                self.connect()
+            self.send(msg)
+            return self.recv()
+        finally:
+            self.deadline = None
+
+    def poll_reply(self):
+        '''
+        Receive whatever data is available, returns the reply frame once it
+        is complete, otherwise None. Only call when the socket is readable.
+        '''
+        if not self.buffer.fill(self.sock):
+            raise socket.error("Connection closed by server")
+        frame, view = self.buffer.pop_frame()
+        if frame is not None:
+            return view.tobytes()
 
     def send(self, msg):
-        if hasattr(msg, 'pack'):
-            msg = msg.pack()
-        logger.info("sending %s bytes", len(msg))
-        self.sock.send(msg)
+        '''
+        Send a message or packed frame. The header and body of a message are
+        sent from separate buffers, the body is never copied into a frame.
+        '''
+        if hasattr(msg, 'buffers'):
+            buffers = msg.buffers()
+        else:
+            buffers = [msg]
+        logger.info("sending %s bytes", sum(len(buf) for buf in buffers))
+        for buf in buffers:
+            view = memoryview(buf)
+            while view:
+                self.wait_for_socket(write=True)
+                sent = self.sock.send(view)
+                self.bytes_sent += sent
+                view = view[sent:]
 
     def recv(self):
-        resp = self._recv(1024)
-        while True:
-            n = SingleMessage.bytes_needed(resp)
-            if n == 0:
-                break
-            # print("get more bytes {}".format(n))
-            resp += self._recv(n)
-        return resp
-
-    def _recv(self, length=0):
-        self.wait_for_socket()
-        return self.sock.recv(length)
-
-    def wait_for_socket(self, timeout=30):
-        start = time.time()
-        while True:
-            readable, writeable, exceptional = select.select([self.sock], [], [])
-            if readable == [self.sock]:
-                return True
-            if time.time() - start > timeout:
+        return self.recv_view().tobytes()
+
+    def recv_view(self):
+        '''
+        Receive a reply frame, returns a memoryview of the frame which is only
+        valid until the next reply is received.
+        '''
+        frame, view = self.buffer.recv_frame(self.sock, self.wait_for_socket)
+        if frame is None:
+            raise socket.error("Connection closed by server")
+        return view
+
+    def wait_for_socket(self, timeout=30, write=False):
+        remaining = self.remaining()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            timeout = remaining
+        if write:
+            readable, writeable, exceptional = select.select(
+                [], [self.sock], [], timeout
+            )
+            ready = writeable
+        else:
+            readable, writeable, exceptional = select.select(
+                [self.sock], [], [], timeout
+            )
+            ready = readable
+        if ready != [self.sock]:
+            raise TimeoutException
+        return True
+
+
+class LatencyTracker(object):
+    '''
+    Keep the latest window request latencies and their percentiles. The
+    sorted samples are refreshed every refresh records.
+    '''
+
+    def __init__(self, window=1000, refresh=50):
+        self.samples = collections.deque(maxlen=window)
+        self.refresh = refresh
+        self._sorted = []
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+            self._pending += 1
+
+    def percentile(self, p):
+        with self._lock:
+            if self._pending >= self.refresh or len(self._sorted) < self.refresh:
+                self._sorted = sorted(self.samples)
+                self._pending = 0
+            if not self._sorted:
+                return None
+            n = int(round(p / 100.0 * (len(self._sorted) - 1)))
+            return self._sorted[n]
+
+
+class ClientPool(object):
+    '''
+    A pool of connected clients to one server. At most max_connections
+    clients are checked out at once, timeout is the per-call deadline of the
+    pooled clients.
+
+    Requests of idempotent methods can be hedged: when no reply arrived
+    after the hedge delay the request is sent again on a second connection,
+    from hedge_pool or this pool, and the first reply wins. The delay is the
+    hedge_percentile of recent latencies once hedge_min_samples requests
+    completed, hedge_delay seconds before that. The losing connection is
+    closed. A request is not hedged when no connection is free for the
+    second request.
+    '''
+
+    def __init__(self, host, port, max_connections=8, timeout=None,
+                 hedge_delay=None, hedge_percentile=None, hedge_min_samples=20,
+                 hedge_pool=None):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_pool = hedge_pool or self
+        self.latencies = LatencyTracker()
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.single_flight = SingleFlight()
+        self.stats = {'hedges': 0, 'hedges_won': 0, 'hedges_skipped': 0}
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    @contextlib.contextmanager
+    def connection(self, blocking=True):
+        '''
+        Check a client out of the pool, connecting a new one when none are
+        idle. Clients are returned to the pool when the block completes and
+        closed if it raised. Without blocking the block gets None when
+        max_connections clients are already checked out.
+        '''
+        if not self._semaphore.acquire(blocking):
+            yield None
+            return
+        client = None
+        try:
+            with self._lock:
+                if self._idle:
+                    client = self._idle.pop()
+            if client is None:
+                client = BasicClient(self.host, self.port, self.timeout)
+            elif client.closed_by_peer():
+                client.reset()
+            yield client
+        except Exception:
+            if client is not None:
+                client.sock.close()
+            client = None
+            raise
+        finally:
+            if client is not None:
+                with self._lock:
+                    self._idle.append(client)
+            self._semaphore.release()
+
+    def request(self, data, idempotent=False):
+        '''
+        Send a request frame on a pooled connection and return the reply.
+
+        The server may close an idle connection at any time. A request that
+        fails on a reused connection is sent once more on a new connection
+        when none of it was sent, or when idempotent is set.
+        '''
+        with self.connection() as client:
+            start = time.time()
+            if client.connected:
+                bytes_sent = client.bytes_sent
+                try:
+                    reply = client.call(data)
+                    self.latencies.record(time.time() - start)
+                    return reply
+                except socket.error:
+                    if client.bytes_sent != bytes_sent and not idempotent:
+                        raise
+                    logger.debug("Pooled connection failed, reconnecting")
+                    client.reset()
+            reply = client.call(data)
+            self.latencies.record(time.time() - start)
+            return reply
+
+    def current_hedge_delay(self):
+        '''
+        Seconds to wait for a reply before hedging, None disables hedging.
+        '''
+        if (self.hedge_percentile is not None and
+                len(self.latencies) >= self.hedge_min_samples):
+            return self.latencies.percentile(self.hedge_percentile)
+        return self.hedge_delay
+
+    def hedged_request(self, data):
+        '''
+        Send a request and return the first reply, sending it again on a
+        second connection when the first is slow to answer.
+        '''
+        delay = self.current_hedge_delay()
+        if delay is None:
+            return self.request(data, idempotent=True)
+        with self.connection() as primary:
+            start = time.time()
+            reused = primary.connected
+            primary.set_deadline(self.timeout)
+            try:
+                try:
+                    if not primary.connected:
+                        primary.connect()
+                    primary.send(data)
+                    readable, writeable, exceptional = select.select(
+                        [primary.sock], [], [], delay
+                    )
+                    if readable:
+                        reply = primary.recv()
+                        self.latencies.record(time.time() - start)
+                        return reply
+                except socket.error:
+                    if not reused:
+                        raise
+                    logger.debug("Pooled connection failed, reconnecting")
+                    primary.reset()
+                    return primary.call(data)
+                with self.hedge_pool.connection(blocking=False) as secondary:
+                    if secondary is None:
+                        # Waiting for a connection could deadlock when the
+                        # primary holds the last one, wait for its reply.
+                        self.count('hedges_skipped')
+                        reply = primary.recv()
+                        self.latencies.record(time.time() - start)
+                        return reply
+                    self.count('hedges')
+                    secondary.set_deadline(self.timeout)
+                    try:
+                        if not secondary.connected:
+                            secondary.connect()
+                        secondary.send(data)
+                        winner, reply = self._first_reply(primary, secondary)
+                    finally:
+                        secondary.deadline = None
+                    # A hedge winning still measures how long the request
+                    # took, leaving it out would drift the hedge delay low.
+                    self.latencies.record(time.time() - start)
+                    if winner is secondary:
+                        self.count('hedges_won')
+                        primary.reset()
+                    else:
+                        secondary.reset()
+                    return reply
+            finally:
+                primary.deadline = None
+
+    def _first_reply(self, *clients):
+        pending = dict((client.sock, client) for client in clients)
+        while pending:
+            remaining = [c.remaining() for c in pending.values()]
+            timeout = None if None in remaining else max(remaining)
+            readable, writeable, exceptional = select.select(
+                list(pending), [], [], timeout
+            )
+            if not readable:
                 raise TimeoutException
+            for sock in readable:
+                client = pending[sock]
+                try:
+                    reply = client.poll_reply()
+                except socket.error:
+                    logger.debug("Hedged connection failed")
+                    client.reset()
+                    del pending[sock]
+                    if not pending:
+                        raise
+                    continue
+                if reply is not None:
+                    return client, reply
+
+    def call(self, method, inputargs):
+        '''
+        Call a RemotingMethod and return the DecodedMessage of the reply.
+
+        When the method has a cache, replies without an exception are cached
+        and later calls with the same arguments return the cached
+        DecodedMessage, which is shared between callers and must not be
+        modified.
+
+        Concurrent calls of an idempotent method with the same arguments
+        send one request and share its reply.
+        '''
+        encoded = method.encode(inputargs)
+        cache = method.cache
+        if cache is not None:
+            result = cache.get(encoded)
+            if result is not MISSING:
+                return result
+        if not method.idempotent:
+            return self._call(method, encoded)
+        key = (method.uri, method.serverinfo, method.methodname, encoded)
+        return self.single_flight.do(key, self._call, method, encoded)
+
+    def _call(self, method, encoded):
+        data = method.pack_encoded(encoded)
+        if method.idempotent:
+            reply = self.hedged_request(data)
+        else:
+            reply = self.request(data)
+        result = decode_message(reply)
+        if method.cache is not None and result.exception is None:
+            method.cache.put(encoded, result)
+        return result
+
+    def send_batch(self, method, arglists):
+        '''
+        Send a request for each list of arguments in one write, without
+        waiting for replies. Meant for methods with the OP_ONEWAYREQUEST
+        operation type.
+        '''
+        data = method.pack_requests(arglists)
+        with self.connection() as client:
+            client.set_deadline(self.timeout)
+            try:
+                if not client.connected:
+                    client.connect()
+                client.send(data)
+            finally:
+                client.deadline = None
+        return len(data)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            client.sock.close()
+
+
+class _PendingCall(object):
+
+    def __init__(self, index, uri, data):
+        self.index = index
+        self.uri = uri
+        self.view = memoryview(data)
+        self.buffer = RecvBuffer()
+        self.connected = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect_ex(address(uri))
+
+    def writable(self):
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            self.connected = True
+        self.view = self.view[self.sock.send(self.view):]
+
+    def readable(self):
+        if not self.buffer.fill(self.sock):
+            raise socket.error("Connection closed by server")
+        frame, view = self.buffer.pop_frame()
+        if frame is not None:
+            return decode_message(view.tobytes())
+
+
+def gather_calls(method, uris, inputargs, concurrency=32, timeout=None):
+    '''
+    Call method with the same arguments on the server of each uri, running
+    up to concurrency calls at once from the calling thread. Returns a list
+    holding, in the order of uris, the DecodedMessage of each reply or the
+    exception the call failed with. Calls still running after timeout
+    seconds fail with TimeoutException.
+
+    Every call uses its own connection which is closed once the reply is in.
+    The message body is encoded once and shared by all the calls.
+    '''
+    body = method.encode_body(inputargs)
+    frames = {}
+    results = [None] * len(uris)
+    queue = list(reversed(list(enumerate(uris))))
+    active = {}
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    def finish(call, result):
+        del active[call.sock]
+        call.sock.close()
+        results[call.index] = result
+
+    while queue or active:
+        while queue and len(active) < concurrency:
+            index, uri = queue.pop()
+            if uri not in frames:
+                frames[uri] = FrameTemplate(
+                    method.operation_type,
+                    [RequestUriHeader(uri), ContentTypeHeader(method.content_type)]
+                ).pack(body)
+            try:
+                call = _PendingCall(index, uri, frames[uri])
+            except Exception as e:
+                results[index] = e
+                continue
+            active[call.sock] = call
+        if not active:
+            continue
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+        writers = [sock for sock, call in active.items() if call.view]
+        readers = [sock for sock, call in active.items() if not call.view]
+        readable, writeable, exceptional = select.select(
+            readers, writers, [], remaining
+        )
+        if not readable and not writeable:
+            for call in active.values():
+                finish(call, TimeoutException(call.uri))
+            for index, uri in queue:
+                results[index] = TimeoutException(uri)
+            break
+        for sock in writeable:
+            call = active[sock]
+            try:
+                call.writable()
+            except Exception as e:
+                finish(call, e)
+        for sock in readable:
+            call = active[sock]
+            try:
+                result = call.readable()
+            except Exception as e:
+                finish(call, e)
+                continue
+            if result is not None:
+                finish(call, result)
+    return results
 
 
 def ppenum(enum):
@@ -184,6 +184,8 @@ class MessageContext(object):
         if self.classes is None:
             self.classes = ClassesContext()
         self.objects = {}
+        # Class records by value hash, used while building messages
+        self.clsvals = {}
 
     @property
     def referenceables(self):
@@ -270,7 +272,10 @@ class MessageContext(object):
 
     def _hashobj(self, obj):
         if isinstance(obj, BinaryObjectString):
-            return hashlib.md5(obj.value).hexdigest()
+            value = obj.value
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            return hashlib.md5(value).hexdigest()
         else:
             raise Exception()
 
@@ -511,13 +516,14 @@ class Arrays(object):
                 refs.append(ref)
             # member refs
         elif isinstance(record, ArraySinglePrimitive):
-            raise TODO()
-            # member prim untyped
-            pass
+            for x in range(record.array_info.length):
+                ref, byts = MemberRef.consume(ctxt, byts, record.primitive_type)
+                refs.append(ref)
         elif isinstance(record, ArraySingleString):
-            raise TODO()
             # (BinaryObjectString/MemberReference/nullObject)
-            pass
+            for x in range(record.array_info.length):
+                ref, byts = MemberRef.consume(ctxt, byts)
+                refs.append(ref)
         else:
             raise StreamError()
         return cls(ctxt, record, refs)
@@ -564,25 +570,34 @@ class MethodCall(object):
     def message_enum(self):
         return self.method.message_enum
 
+    def stream(self):
+        stream = []
+        if self.lib:
+            stream.append(self.lib)
+        stream.append(self.method)
+        if self.array:
+            stream.extend(self.array.stream())
+        return stream
+
     def pack(self):
         data = ''
         if self.lib:
-            data = lib.pack()
+            data = self.lib.pack()
         data += self.method.pack()
         if self.array:
             data += self.array.pack()
         return data
 
     @classmethod
-    def unpack(cls, byts):
+    def unpack(cls, ctxt, byts):
         lib, byts = _consume_record(BinaryLibrary, byts)
         method, byts = _consume_record(BinaryMethodCall, byts)
         if not method:
             raise StreamError("Expected library and/or method call")
         arry = None
         if cls._should_have_array(method):
-            arry, byts = CallArray.consume(byts)
-        return cls(lib, method, arry)
+            arry, byts = CallArray.consume(ctxt, byts)
+        return cls(ctxt, lib, method, arry)
 
     @classmethod
     def _should_have_array(cls, method):
@@ -593,8 +608,8 @@ class MethodCall(object):
         return False
 
     @classmethod
-    def consume(cls, byts):
-        o = cls.unpack(byts)
+    def consume(cls, ctxt, byts):
+        o = cls.unpack(ctxt, byts)
         return o, _remove_byts(o.pack(), byts)
 
 
@@ -917,8 +932,6 @@ class RemotingMessage(object):
     def build_method_return(
             cls, value=None, exception=None, ctxt=None,
             context_cls=MessageContext):
-        cls.clsvals = {}
-        cls.objects = {}
         if ctxt is None:
             ctxt = context_cls()
         # TODO: Header values based on value type and  exception
@@ -926,18 +939,68 @@ class RemotingMessage(object):
         method = MethodReturn(ctxt)
         if exception:
             method.method = BinaryMethodReturn(MessageEnum(ExceptionInArray=True))
-            ctxt.set_method(method)
-            arrayrec = ArraySingleObject(ArrayInfo(ctxt.next_id(), 1))
-            method.array = CallArray(ctxt, array=arrayrec)
-            method.array.refs.append(excepion)
+            value = exception
         else:
             # TODO: Enum values based on exception and value type
             method.method = BinaryMethodReturn(MessageEnum(ReturnValueInArray=True))
-            ctxt.set_method(method)
-            if not cls._is_object(value):
-                raise Exception
-            arrayrec = ArraySingleObject(ArrayInfo(ctxt.next_id(), 1))
-            method.array = CallArray(ctxt, array=arrayrec)
+        ctxt.set_method(method)
+        if not cls._is_object(value):
+            raise Exception
+        cls.build_call_array(ctxt, [value])
+        ctxt.set_message_end(MessageEnd())
+        return cls(ctxt)
+
+    @classmethod
+    def build_method_call_array(
+            cls, method, values, arg_spec=None, ctxt=None,
+            context_cls=MessageContext):
+        '''
+        Build a method call passing its arguments in a call array, method is
+        a BinaryMethodCall with ArgsIsArray set, each value is an item of
+        the call array. See build_call_array for values and arg_spec.
+        '''
+        if ctxt is None:
+            ctxt = context_cls()
+        ctxt.set_header(SerializationHeader(1, -1, 1))
+        ctxt.set_method(MethodCall(ctxt, method=method))
+        cls.build_call_array(ctxt, values, arg_spec)
+        ctxt.set_message_end(MessageEnd())
+        return cls(ctxt)
+
+    @classmethod
+    def build_call_array(cls, ctxt, values, arg_spec=None):
+        '''
+        Add a call array holding values to the method of ctxt. arg_spec is
+        the (BinaryTypeEnumeration, PrimitiveTypeEnumeration) pair of each
+        value. Primitives are passed as typed primitives, lists of primitives
+        and strings as primitive and string arrays and lists of objects as
+        object arrays. Without arg_spec the values must be strings, objects
+        or ObjArrays.
+        '''
+        if arg_spec is None:
+            arg_spec = [(None, None)] * len(values)
+        arrayrec = ArraySingleObject(ArrayInfo(ctxt.next_id(), len(values)))
+        ctxt.method.array = CallArray(ctxt, array=arrayrec)
+        for value, (btype, kind) in zip(values, arg_spec):
+            kind = getattr(kind, 'enum', kind)
+            if value is not None and btype is not None:
+                if btype == bt.PRIMITIVE:
+                    rec = MemberPrimitiveTyped(kind, primitive(kind, value))
+                    ctxt.method.array.refs.append(MemberRef(ctxt, ref=rec))
+                    continue
+                if btype == bt.PRIMITIVE_ARRAY:
+                    ctxt.method.array.refs.append(
+                        cls.build_primitive_array(ctxt, kind, value)
+                    )
+                    continue
+                if btype == bt.STRING_ARRAY:
+                    ctxt.method.array.refs.append(
+                        cls.build_string_array(ctxt, value)
+                    )
+                    continue
+                if btype == bt.OBJECT_ARRAY and not cls._is_array(value):
+                    from remoting_types import ObjArray
+                    value = ObjArray(list(value))
             for parent, n, node in cls.nodeiter(value):
                 if cls._is_object(node):
                     cls.handle_cls(ctxt, parent, n, node)
@@ -945,8 +1008,40 @@ class RemotingMessage(object):
                     cls.handle_ary(ctxt, parent, n, node)
                 else:
                     cls.handle_typ(ctxt, parent, n, node)
-        ctxt.set_message_end(MessageEnd())
-        return cls(ctxt)
+
+    @classmethod
+    def build_primitive_array(cls, ctxt, kind, values):
+        '''
+        Add an ArraySinglePrimitive holding values to the referenceables of
+        ctxt, returns a reference to it.
+        '''
+        record = ArraySinglePrimitive(ArrayInfo(ctxt.next_id(), len(values)), kind)
+        refs = [
+            MemberRef(
+                ctxt, ref=MemberPrimitiveUnTyped(kind, primitive(kind, value)),
+                typ=kind
+            )
+            for value in values
+        ]
+        ctxt.append_referenceable(Referenceable(ctxt, Arrays(ctxt, record, refs)))
+        return MemberRef(ctxt, ref=MemberReference(record.object_id))
+
+    @classmethod
+    def build_string_array(cls, ctxt, values):
+        '''
+        Add an ArraySingleString holding values to the referenceables of
+        ctxt, returns a reference to it.
+        '''
+        record = ArraySingleString(ArrayInfo(ctxt.next_id(), len(values)))
+        refs = []
+        for value in values:
+            if value is None:
+                refs.append(MemberRef(ctxt, ref=NullObject(ctxt, ObjectNull())))
+            else:
+                rec = BinaryObjectString(object_id=ctxt.next_id(), value=value)
+                refs.append(MemberRef(ctxt, ref=rec))
+        ctxt.append_referenceable(Referenceable(ctxt, Arrays(ctxt, record, refs)))
+        return MemberRef(ctxt, ref=MemberReference(record.object_id))
 
     @staticmethod
     def _is_object(val):
@@ -961,10 +1056,10 @@ class RemotingMessage(object):
     @classmethod
     def build_system_class(cls, value, ctxt):
         vhash = value.hash_values()
-        if vhash in cls.clsvals:
-            logger.debug('hash exists %s %s', value, cls.clsvals[vhash].object_id)
+        if vhash in ctxt.clsvals:
+            logger.debug('hash exists %s %s', value, ctxt.clsvals[vhash].object_id)
             ctxt.next_id()
-            return cls.clsvals[vhash], True
+            return ctxt.clsvals[vhash], True
             # raise ClassExists()
             # raise Exception
         clsrec = ctxt.get_class(value._class)
@@ -984,8 +1079,8 @@ class RemotingMessage(object):
             member_info = MemberTypeInfo(value.member_info())
             clsrecord = SystemClassWithMembersAndTypes(class_info, member_info)
             ctxt.add_class(clsrecord)
-        if vhash not in cls.clsvals:
-            cls.clsvals[vhash] = clsrecord
+        if vhash not in ctxt.clsvals:
+            ctxt.clsvals[vhash] = clsrecord
         return clsrecord, False
 
     @classmethod
@@ -995,7 +1090,7 @@ class RemotingMessage(object):
                 return - x
             return x
         vhash = value.hash_values()
-        if vhash in cls.clsvals:
+        if vhash in ctxt.clsvals:
             raise ClassExists(value)
         libs = []
         lib = None
@@ -1022,7 +1117,7 @@ class RemotingMessage(object):
             member_info_rec = MemberTypeInfo(value.member_info())
             clsrecord = ClassWithMembersAndTypes(class_info_rec, member_info_rec, lib_id)
             ctxt.add_class(clsrecord)
-        cls.clsvals[vhash] = clsrecord
+        ctxt.clsvals[vhash] = clsrecord
         return clsrecord, lib
 
     @classmethod
@@ -1122,8 +1217,10 @@ class RemotingMessage(object):
         if cls._is_object(parent):
             nbt, npt = parent.member_info()[n]
             if nbt == bt.PRIMITIVE:
-                rec = MemberPrimitiveUnTyped(typ=npt, value=node)
+                rec = MemberPrimitiveUnTyped(typ=npt, value=primitive(npt, node))
                 ref = MemberRef(ctxt, ref=rec, typ=npt)
+            elif node is None:
+                ref = MemberRef(ctxt, ref=NullObject(ctxt, ObjectNull()))
             else:
                 tmprec = BinaryObjectString(object_id=None, value=node)
                 existing_rec = ctxt.get_object(tmprec)
@@ -1151,6 +1248,8 @@ class RemotingMessage(object):
                 #     tmprec.object_id = ctxt.next_id()
                 #     ctxt.add_object(tmprec)
                 #     ref = MemberRef(ctxt, ref=tmprec)
+            elif node is None:
+                ref = MemberRef(ctxt, ref=NullObject(ctxt, ObjectNull()))
             else:
                 # print(node)
                 raise Exception
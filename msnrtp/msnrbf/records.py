@@ -407,14 +407,18 @@ class MemberPrimitiveTyped(BinaryRecord):
         self.value = value
         self.referenced = False
 
+    def __repr__(self):
+        return '<MemberPrimitiveTyped({}, {})>'.format(self.typ, self.value)
+
     def pack(self):
-        return self.pack_type() + self.value.pack()
+        return self.pack_type() + struct.pack('<B', self.typ) + self.value.pack()
 
     @classmethod
     def unpack(cls, byts):
         ibyts = cls._getbytes(byts)
         typenum, = struct.unpack('<B', ibyts[0])
-        value = unpack_primitive_type(typ, byts)
+        value = unpack_primitive_type(typenum, ibyts[1:])
+        return cls(typenum, value)
 
 
 class MemberReference(BinaryRecord):
@@ -551,10 +555,9 @@ class ArraySinglePrimitive(BinaryRecord):
     '''
     enum = 15
 
-    def __init__(self, array_info, enum):
-        raise TODO()
+    def __init__(self, array_info, primitive_type):
         self.array_info = array_info
-        self.enum = enum
+        self.primitive_type = primitive_type
         self.referenced = False
 
     @property
@@ -572,18 +575,22 @@ class ArraySinglePrimitive(BinaryRecord):
         if not isinstance(other, ArraySinglePrimitive):
             logger.warn("Not a matching instance type %s", other)
             return False
-        return self.array_info == other.array_info
+        return (
+            self.array_info == other.array_info and
+            self.primitive_type == other.primitive_type
+        )
 
     def pack(self):
-        return self.pack_type() + self.array_info.pack() + struct.pack('<B', self.enum)
+        return self.pack_type() + self.array_info.pack() + \
+            struct.pack('<B', self.primitive_type)
 
     @classmethod
     def unpack(cls, byts):
         ibyts = cls._getbytes(byts)
         array_info = ArrayInfo.unpack(ibyts)
         ibyts = ibyts[len(array_info.pack()):]
-        enum = struct.unpack('<B', ibyts[0])
-        return cls(array_info, enum)
+        primitive_type, = struct.unpack('<B', ibyts[:1])
+        return cls(array_info, primitive_type)
 
 
 class ArraySingleObject(BinaryRecord):
@@ -625,11 +632,12 @@ class ArraySingleObject(BinaryRecord):
 
 class ArraySingleString(BinaryRecord):
     '''
+    The ArraySingleString record contains a single dimensional array whose
+    items are strings.
     '''
     enum = 17
 
     def __init__(self, array_info):
-        raise TODO()
         self.array_info = array_info
         self.referenced = False
 
@@ -642,10 +650,10 @@ class ArraySingleString(BinaryRecord):
         self.array_info.object_id = object_id
 
     def __repr__(self):
-        return '<ArraySingleObject({}) at {}>'.format(self.array_info, hex(id(self)))
+        return '<ArraySingleString({}) at {}>'.format(self.array_info, hex(id(self)))
 
     def __eq__(self, other):
-        if not isinstance(other, ArraySingleObject):
+        if not isinstance(other, ArraySingleString):
             logger.warn("Not a matching instance type %s", other)
             return False
         return self.array_info == other.array_info
@@ -655,7 +663,6 @@ class ArraySingleString(BinaryRecord):
 
     @classmethod
     def unpack(cls, byts):
-        raise TODO()
         ibyts = cls._getbytes(byts)
         return cls(ArrayInfo.unpack(ibyts))
 
@@ -0,0 +1,468 @@
+'''
+Walk the records of a message body without building record objects.
+
+The scanner reads record headers and class metadata with struct and skips
+everything it is not asked for: untyped primitive members are skipped by
+their size, strings by their length prefix. Only the members named by a
+projection are decoded. scan_records lists where each record starts and
+ends.
+'''
+import collections
+import struct
+from .enum import binary_type as bt
+from .enum import primitive_type as pt
+from .enum.message_enum import MessageEnum
+from .grammar import StreamError
+from .types import FORMATS, unpack_length_from, unpack_primitive_type
+
+
+_BYTE = struct.Struct('<B')
+_INT32 = struct.Struct('<i')
+
+_STRUCTS = dict((kind, struct.Struct(fmt)) for kind, fmt in FORMATS.items())
+
+# Record types, MS-NRBF 2.1.2.1
+SERIALIZATION_HEADER = 0
+CLASS_WITH_ID = 1
+SYSTEM_CLASS_WITH_MEMBERS = 2
+CLASS_WITH_MEMBERS = 3
+SYSTEM_CLASS_WITH_MEMBERS_AND_TYPES = 4
+CLASS_WITH_MEMBERS_AND_TYPES = 5
+BINARY_OBJECT_STRING = 6
+BINARY_ARRAY = 7
+MEMBER_PRIMITIVE_TYPED = 8
+MEMBER_REFERENCE = 9
+OBJECT_NULL = 10
+MESSAGE_END = 11
+BINARY_LIBRARY = 12
+OBJECT_NULL_MULTIPLE_256 = 13
+OBJECT_NULL_MULTIPLE = 14
+ARRAY_SINGLE_PRIMITIVE = 15
+ARRAY_SINGLE_OBJECT = 16
+ARRAY_SINGLE_STRING = 17
+BINARY_METHOD_CALL = 21
+BINARY_METHOD_RETURN = 22
+
+# BinaryArray types with lower bounds, MS-NRBF 2.4.1.1
+_OFFSET_ARRAY_TYPES = (3, 4, 5)
+
+
+# A member holding an object, array or string record by its object id
+Reference = collections.namedtuple('Reference', ['object_id'])
+
+ClassMetadata = collections.namedtuple(
+    'ClassMetadata', ['name', 'member_names', 'member_types']
+)
+
+
+class Scanner(object):
+    '''
+    Scan the records of a message body starting at offset.
+
+    names is the set of member names to decode, members with other names are
+    skipped. Decoded members are kept in objects, a mapping of object id to
+    class name and member values, in stream order. A member holding a record
+    is kept as a Reference to the record's object id, the offsets of string
+    records are kept in strings.
+
+    With records set to a list the scanner appends a (record_type, offset,
+    length, object_id) tuple for every record, see scan_records.
+    '''
+
+    def __init__(self, byts, offset=0, names=(), records=None, end=None):
+        self.byts = byts
+        self.offset = offset
+        self.end = len(byts) if end is None else end
+        self.names = frozenset(names)
+        self.records = records
+        self.classes = {}
+        self.objects = collections.OrderedDict()
+        self.strings = {}
+
+    def scan(self):
+        '''
+        Scan records up to and including the MessageEnd record, returns the
+        offset after it.
+        '''
+        try:
+            if self.record()[0] != SERIALIZATION_HEADER:
+                raise StreamError("Message does not start with a header")
+            while self.record()[0] != MESSAGE_END:
+                pass
+        except struct.error as e:
+            raise StreamError("Truncated message: {}".format(e))
+        return self.offset
+
+    def _byte(self):
+        value, = _BYTE.unpack_from(self.byts, self.offset)
+        self.offset += 1
+        return value
+
+    def _int32(self):
+        value, = _INT32.unpack_from(self.byts, self.offset)
+        self.offset += 4
+        return value
+
+    def _skip_string(self):
+        length, offset = unpack_length_from(self.byts, self.offset)
+        self.offset = offset + length
+
+    def _string(self):
+        length, offset = unpack_length_from(self.byts, self.offset)
+        self.offset = offset + length
+        return bytes(self.byts[offset:self.offset]).decode('utf-8')
+
+    def string_at(self, object_id):
+        '''
+        The value of the string record with object_id.
+        '''
+        length, offset = unpack_length_from(self.byts, self.strings[object_id])
+        return bytes(self.byts[offset:offset + length]).decode('utf-8')
+
+    def _skip_primitive(self, kind):
+        fmt = _STRUCTS.get(kind)
+        if fmt is not None:
+            self.offset += fmt.size
+        elif kind in (pt.STRING, pt.DECIMAL):
+            self._skip_string()
+        elif kind == pt.DATETIME:
+            self.offset += 8
+        elif kind == pt.CHAR:
+            self.offset += len(unpack_primitive_type(
+                kind, bytes(self.byts[self.offset:self.offset + 4])
+            ).pack())
+        elif kind != pt.NULL:
+            raise StreamError("Invalid primitive type: {}".format(kind))
+
+    def _primitive(self, kind):
+        start = self.offset
+        self._skip_primitive(kind)
+        fmt = _STRUCTS.get(kind)
+        if fmt is not None:
+            return fmt.unpack_from(self.byts, start)[0]
+        if kind == pt.NULL:
+            return None
+        value = unpack_primitive_type(kind, bytes(self.byts[start:self.offset]))
+        if kind == pt.DATETIME:
+            return value
+        return value.value
+
+    def _count(self):
+        value = self._int32()
+        if value < 0:
+            raise StreamError("Invalid count: {}".format(value))
+        return value
+
+    def _skip_value_with_code(self):
+        self._skip_primitive(self._byte())
+
+    def record(self):
+        '''
+        Read one record and the records nested in it. Returns the record type
+        and the value a member holding the record gets: a primitive value,
+        a Reference, None for null and the number of nulls for the null
+        multiple records.
+        '''
+        start = self.offset
+        record_type = self._byte()
+        if record_type == BINARY_LIBRARY:
+            library_id = self._int32()
+            self._skip_string()
+            self._add_record(record_type, start, library_id)
+            start = self.offset
+            record_type = self._byte()
+        if self.records is None:
+            value = self._read(record_type)
+        else:
+            # Nested records are appended while this one is read, its entry
+            # is filled in once its length is known.
+            index = len(self.records)
+            self.records.append(None)
+            value = self._read(record_type)
+            object_id = 0
+            if isinstance(value, Reference) and record_type != MEMBER_REFERENCE:
+                object_id = value.object_id
+            self.records[index] = (
+                record_type, start, self.offset - start, object_id
+            )
+        if self.offset > self.end:
+            raise StreamError("Record at {} ends past the message".format(start))
+        return record_type, value
+
+    def _add_record(self, record_type, start, object_id):
+        if self.offset > self.end:
+            raise StreamError("Record at {} ends past the message".format(start))
+        if self.records is not None:
+            self.records.append(
+                (record_type, start, self.offset - start, object_id)
+            )
+
+    def _read(self, record_type):
+        if record_type in _CLASS_RECORDS:
+            return Reference(self._class(record_type))
+        if record_type == BINARY_OBJECT_STRING:
+            object_id = self._int32()
+            self.strings[object_id] = self.offset
+            self._skip_string()
+            return Reference(object_id)
+        if record_type == MEMBER_REFERENCE:
+            return Reference(self._int32())
+        if record_type == MEMBER_PRIMITIVE_TYPED:
+            return self._primitive(self._byte())
+        if record_type == OBJECT_NULL:
+            return None
+        if record_type == OBJECT_NULL_MULTIPLE_256:
+            return self._byte()
+        if record_type == OBJECT_NULL_MULTIPLE:
+            return self._count()
+        if record_type in (ARRAY_SINGLE_OBJECT, ARRAY_SINGLE_STRING):
+            object_id = self._int32()
+            self._elements(self._count())
+            return Reference(object_id)
+        if record_type == ARRAY_SINGLE_PRIMITIVE:
+            object_id = self._int32()
+            length = self._count()
+            self._primitives(self._byte(), length)
+            return Reference(object_id)
+        if record_type == BINARY_ARRAY:
+            return Reference(self._binary_array())
+        if record_type == SERIALIZATION_HEADER:
+            self.offset += 16
+            return None
+        if record_type in (BINARY_METHOD_CALL, BINARY_METHOD_RETURN):
+            self._method(record_type)
+            return None
+        if record_type == MESSAGE_END:
+            return None
+        raise StreamError("Invalid record type: {}".format(record_type))
+
+    def _elements(self, length):
+        # Array elements are records, null multiple records stand for
+        # several elements.
+        count = 0
+        while count < length:
+            record_type, value = self.record()
+            if record_type in (OBJECT_NULL_MULTIPLE_256, OBJECT_NULL_MULTIPLE):
+                count += value
+            elif record_type in _MEMBER_RECORDS:
+                count += 1
+            else:
+                raise StreamError(
+                    "Invalid array element record: {}".format(record_type)
+                )
+        if count > length:
+            raise StreamError("Null records past the end of an array")
+
+    def _primitives(self, kind, length):
+        fmt = _STRUCTS.get(kind)
+        if fmt is not None:
+            self.offset += fmt.size * length
+        else:
+            for _ in range(length):
+                self._skip_primitive(kind)
+
+    def _binary_array(self):
+        object_id = self._int32()
+        array_type = self._byte()
+        rank = self._count()
+        length = 1
+        for _ in range(rank):
+            length *= self._count()
+        if array_type in _OFFSET_ARRAY_TYPES:
+            self.offset += 4 * rank
+        binary_type = self._byte()
+        kind = self._additional_info(binary_type)
+        if binary_type == bt.PRIMITIVE:
+            self._primitives(kind, length)
+        else:
+            self._elements(length)
+        return object_id
+
+    def _method(self, record_type):
+        enum = MessageEnum.fromword(self._int32())
+        if record_type == BINARY_METHOD_CALL:
+            self._skip_value_with_code()
+            self._skip_value_with_code()
+        elif enum.ReturnValueInline:
+            self._skip_value_with_code()
+        if enum.ContextInline:
+            self._skip_value_with_code()
+        if enum.ArgsInline:
+            for _ in range(self._count()):
+                self._skip_value_with_code()
+
+    def _additional_info(self, binary_type):
+        if binary_type in (bt.PRIMITIVE, bt.PRIMITIVE_ARRAY):
+            return self._byte()
+        if binary_type == bt.SYSTEM_CLASS:
+            self._skip_string()
+        elif binary_type == bt.CLASS:
+            self._skip_string()
+            self.offset += 4
+        elif binary_type > bt.PRIMITIVE_ARRAY:
+            raise StreamError("Invalid binary type: {}".format(binary_type))
+
+    def _class(self, record_type):
+        object_id = self._int32()
+        if record_type == CLASS_WITH_ID:
+            metadata_id = self._int32()
+            if metadata_id not in self.classes:
+                raise StreamError("Unknown class metadata: {}".format(metadata_id))
+            metadata = self.classes[metadata_id]
+        else:
+            name = self._string()
+            member_names = [self._string() for _ in range(self._count())]
+            member_types = None
+            if record_type in (SYSTEM_CLASS_WITH_MEMBERS_AND_TYPES,
+                               CLASS_WITH_MEMBERS_AND_TYPES):
+                binary_types = [self._byte() for _ in member_names]
+                member_types = [
+                    (binary_type, self._additional_info(binary_type))
+                    for binary_type in binary_types
+                ]
+            if record_type in (CLASS_WITH_MEMBERS, CLASS_WITH_MEMBERS_AND_TYPES):
+                self.offset += 4
+            metadata = ClassMetadata(name, member_names, member_types)
+            self.classes[object_id] = metadata
+        members = {}
+        for n, name in enumerate(metadata.member_names):
+            wanted = name in self.names
+            if metadata.member_types and metadata.member_types[n][0] == bt.PRIMITIVE:
+                kind = metadata.member_types[n][1]
+                if wanted:
+                    members[name] = self._primitive(kind)
+                else:
+                    self._skip_primitive(kind)
+            else:
+                record_type, value = self.record()
+                if record_type not in _MEMBER_RECORDS:
+                    raise StreamError(
+                        "Invalid member record: {}".format(record_type)
+                    )
+                if wanted:
+                    members[name] = value
+        if members:
+            self.objects[object_id] = (metadata.name, members)
+        return object_id
+
+
+_CLASS_RECORDS = frozenset([
+    CLASS_WITH_ID, SYSTEM_CLASS_WITH_MEMBERS, CLASS_WITH_MEMBERS,
+    SYSTEM_CLASS_WITH_MEMBERS_AND_TYPES, CLASS_WITH_MEMBERS_AND_TYPES,
+])
+
+# Records allowed as a class member value or array element, MS-NRBF 2.7
+_MEMBER_RECORDS = _CLASS_RECORDS | frozenset([
+    BINARY_OBJECT_STRING, MEMBER_REFERENCE, MEMBER_PRIMITIVE_TYPED,
+    OBJECT_NULL, ARRAY_SINGLE_OBJECT, ARRAY_SINGLE_PRIMITIVE,
+    ARRAY_SINGLE_STRING, BINARY_ARRAY,
+])
+
+
+def scan_records(byts, offset=0, end=None):
+    '''
+    Validate a message body and list its records without decoding them.
+
+    Returns a list of (record_type, offset, length, object_id) tuples in
+    stream order. A record's length covers the records and primitive values
+    nested in it, nested records are listed after the record holding them.
+    object_id is the library id of BinaryLibrary records and 0 for records
+    without an object id. Raises StreamError when the body does not follow
+    the record grammar or is truncated.
+    '''
+    records = []
+    Scanner(byts, offset, records=records, end=end).scan()
+    return records
+
+
+def inline_args(byts, offset=0, kinds=None):
+    '''
+    Read the inline arguments of the method call in a message body, nothing
+    else is decoded. Returns None when the call passes its arguments in a
+    call array.
+
+    kinds, a list of primitive types, checks the number of arguments and the
+    type of each, a null is accepted for any argument.
+    '''
+    scanner = Scanner(byts, offset)
+    try:
+        if scanner._byte() != SERIALIZATION_HEADER:
+            raise StreamError("Message does not start with a header")
+        scanner.offset += 16
+        record_type = scanner._byte()
+        if record_type == BINARY_LIBRARY:
+            scanner._int32()
+            scanner._skip_string()
+            record_type = scanner._byte()
+        if record_type != BINARY_METHOD_CALL:
+            raise StreamError("Message is not a method call")
+        enum = MessageEnum.fromword(scanner._int32())
+        if not enum.ArgsInline:
+            return None
+        scanner._skip_value_with_code()
+        scanner._skip_value_with_code()
+        if enum.ContextInline:
+            scanner._skip_value_with_code()
+        count = scanner._count()
+        if kinds is not None and count != len(kinds):
+            raise StreamError(
+                "Expected {} arguments, got {}".format(len(kinds), count)
+            )
+        args = []
+        for n in range(count):
+            kind = scanner._byte()
+            if kinds is not None and kind not in (kinds[n], pt.NULL):
+                raise StreamError("Argument {} has type {}, expected {}".format(
+                    n, kind, kinds[n]
+                ))
+            args.append(scanner._primitive(kind))
+    except struct.error as e:
+        raise StreamError("Truncated message: {}".format(e))
+    return args
+
+
+def _class_matches(name, class_name):
+    return name == class_name or name.endswith('.' + class_name)
+
+
+def project(byts, paths, offset=0):
+    '''
+    Extract members from a message body without decoding it.
+
+    A path is a class name followed by member names, for example
+    ('Order', 'Customer', 'Id'). The class name may leave out the namespace.
+    Returns a mapping of each path to the values it reaches, one per object
+    of the class in stream order. Objects and arrays at the end of a path are
+    returned as a Reference, strings and primitives as their value.
+    '''
+    paths = [tuple(path) for path in paths]
+    names = set()
+    for path in paths:
+        names.update(path[1:])
+    scanner = Scanner(byts, offset, names)
+    scanner.scan()
+    results = dict((path, []) for path in paths)
+    for object_id, (name, members) in scanner.objects.items():
+        for path in paths:
+            if _class_matches(name, path[0]):
+                found, value = _follow(scanner, members, path[1:])
+                if found:
+                    results[path].append(value)
+    return results
+
+
+def _follow(scanner, members, names):
+    value = None
+    for n, name in enumerate(names):
+        if name not in members:
+            return False, None
+        value = members[name]
+        if not isinstance(value, Reference):
+            return n == len(names) - 1, value
+        if n < len(names) - 1:
+            if value.object_id not in scanner.objects:
+                return False, None
+            members = scanner.objects[value.object_id][1]
+    if isinstance(value, Reference) and value.object_id in scanner.strings:
+        return True, scanner.string_at(value.object_id)
+    return True, value
@@ -5,7 +5,7 @@ MS-NRBF 2.3.1 Common Structures
 '''
 from types import (
     LengthPrefixedString, consume_primitive_type, unpack_primitive_type,
-    pack_primitive_type
+    pack_primitive_type, primitive, pack_length_prefix, FORMATS, Datetime
 )
 from enum import *
 import struct
@@ -189,11 +189,46 @@ class ValueWithCode(object):
 
     @classmethod
     def unpack(cls, byts):
-        enum = PrimitiveTypeEnum.unpack(byts[:1])
+        enum = pt.PrimitiveTypeEnum.unpack(byts[:1])
         value = unpack_primitive_type(enum.enum, byts[1:])
+        if isinstance(value, Datetime):
+            # Keep the ticks and kind, a datetime would lose them
+            return cls(enum.enum, value)
         return cls(enum.enum, value.value)
 
 
+_NULL_CODE = struct.pack('<B', primitive_type.NULL)
+
+
+def value_with_code_encoder(kind):
+    '''
+    Return a function packing a value of a primitive type as a
+    ValueWithCode, a None value is packed as Null.
+    '''
+    if isinstance(kind, primitive_type.PrimitiveTypeEnum):
+        kind = kind.enum
+    code = struct.pack('<B', kind)
+    if kind in FORMATS:
+        fmt = struct.Struct('<B' + FORMATS[kind][1:])
+
+        def encode(value):
+            if value is None:
+                return _NULL_CODE
+            return fmt.pack(kind, value)
+    elif kind == primitive_type.STRING:
+        def encode(value):
+            if value is None:
+                return _NULL_CODE
+            data = value.encode('utf-8')
+            return code + pack_length_prefix(len(data)) + data
+    else:
+        def encode(value):
+            if value is None:
+                return _NULL_CODE
+            return code + primitive(kind, value).pack()
+    return encode
+
+
 class ArrayOfValueWithCode(object):
 
     def __init__(self, values):
@@ -6,6 +6,7 @@ remoting protocole MS-NRTP and the binary message format MS-NRBF.
 MS-NRBF - 2.1.1 Common Data Types
 '''
 import binascii
+import datetime
 import struct
 import logging
 from enum import primitive_type
@@ -91,6 +92,41 @@ def unpack_length(byts):
     return length, idx
 
 
+_BYTE = struct.Struct('<B')
+
+
+def pack_length_prefix(length):
+    '''
+    Encode a length prefix (MS-NRBF 2.1.1.6), seven bits per byte with the
+    high bit set on all but the last byte. Same result as pack_length.
+    '''
+    parts = []
+    while length > 0x7f:
+        parts.append(_BYTE.pack(length & 0x7f | 0x80))
+        length >>= 7
+    parts.append(_BYTE.pack(length))
+    return b''.join(parts)
+
+
+def unpack_length_from(byts, offset=0):
+    '''
+    Read a length prefix starting at offset of any buffer (str, bytearray or
+    memoryview). Returns the length and the offset of the first byte after
+    the prefix. A length prefix is at most five bytes long (MS-NRBF 2.1.1.6).
+    '''
+    length = 0
+    shift = 0
+    while True:
+        b, = _BYTE.unpack_from(byts, offset)
+        offset += 1
+        length |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return length, offset
+        shift += 7
+        if shift > 28:
+            raise Exception("Invalid length prefix")
+
+
 class PrimitiveType(object):
     enum = None
 
@@ -129,10 +165,11 @@ class LengthPrefixedString(PrimitiveType):
 
     @property
     def encoded_length(self):
-        return pack_length(self.length)
+        return pack_length_prefix(self.length)
 
     def pack(self):
-        return self.encoded_length + self.value.encode('utf-8')
+        data = self.value.encode('utf-8')
+        return pack_length_prefix(len(data)) + data
 
     @classmethod
     def unpack(cls, byts):
@@ -237,10 +274,23 @@ class UInt64(PrimitiveType):
         return cls(*struct.unpack('<Q', byts[:8]))
 
 
+_DATETIME = struct.Struct('<Q')
+_TICKS_MASK = (1 << 62) - 1
+_TICKS_EPOCH = datetime.datetime(1, 1, 1)
+
+
 class Datetime(PrimitiveType):
+    '''
+    A number of 100 nanosecond ticks since 0001-01-01 and a kind, packed as
+    a little endian Int64 with the kind in the two highest bits (MS-NRBF
+    2.1.1.5). The kind is 0 when unspecified, 1 for UTC and 2 for local time.
+    '''
     enum = primitive_type.DATETIME
+    UNSPECIFIED = 0
+    UTC = 1
+    LOCAL = 2
 
-    def __init__(self, ticks, tzinfo):
+    def __init__(self, ticks, tzinfo=UNSPECIFIED):
         self.ticks = ticks
         self.tzinfo = tzinfo
 
@@ -249,32 +299,213 @@ class Datetime(PrimitiveType):
             'Datetime', self.ticks, self.tzinfo, hex(id(self))
         )
 
+    def __eq__(self, other):
+        if isinstance(other, Datetime):
+            return self.ticks == other.ticks and self.tzinfo == other.tzinfo
+        return False
+
+    @property
+    def value(self):
+        '''
+        The ticks as a naive datetime, truncated to microseconds.
+        '''
+        return _TICKS_EPOCH + datetime.timedelta(microseconds=self.ticks // 10)
+
+    @classmethod
+    def from_datetime(cls, value):
+        '''
+        Aware datetimes are converted to UTC, naive ones have an unspecified
+        kind.
+        '''
+        kind = cls.UNSPECIFIED
+        offset = value.utcoffset()
+        if offset is not None:
+            value = value.replace(tzinfo=None) - offset
+            kind = cls.UTC
+        delta = value - _TICKS_EPOCH
+        seconds = delta.days * 86400 + delta.seconds
+        return cls(seconds * 10000000 + delta.microseconds * 10, kind)
+
+    def pack(self):
+        return _DATETIME.pack(self.ticks | self.tzinfo << 62)
+
+    @classmethod
+    def unpack(cls, byts):
+        n, = _DATETIME.unpack_from(byts)
+        return cls(n & _TICKS_MASK, n >> 62)
+
+
+class FixedPrimitive(PrimitiveType):
+    '''
+    A primitive packed as a single fixed size struct field.
+    '''
+    fmt = None
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return '<{}({}) at {}>'.format(
+            type(self).__name__, self.value, hex(id(self))
+        )
+
+    def pack(self):
+        return self.fmt.pack(self.value)
+
+    @classmethod
+    def unpack(cls, byts):
+        return cls(*cls.fmt.unpack_from(byts))
+
+
+class Byte(FixedPrimitive):
+    enum = primitive_type.BYTE
+    fmt = struct.Struct('<B')
+
+
+class SByte(FixedPrimitive):
+    enum = primitive_type.SBYTE
+    fmt = struct.Struct('<b')
+
+
+class Int16(FixedPrimitive):
+    enum = primitive_type.INT16
+    fmt = struct.Struct('<h')
+
+
+class UInt16(FixedPrimitive):
+    enum = primitive_type.UINT16
+    fmt = struct.Struct('<H')
+
+
+class UInt32(FixedPrimitive):
+    enum = primitive_type.UINT32
+    fmt = struct.Struct('<I')
+
+
+class Double(FixedPrimitive):
+    enum = primitive_type.DOUBLE
+    fmt = struct.Struct('<d')
+
+
+class TimeSpan(FixedPrimitive):
+    '''
+    A duration as a number of 100 nanosecond ticks.
+    '''
+    enum = primitive_type.TIMESPAN
+    fmt = struct.Struct('<q')
+
+
+class Char(PrimitiveType):
+    '''
+    A single unicode character, packed as its UTF-8 encoding.
+    '''
+    enum = primitive_type.CHAR
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return '<Char({})>'.format(repr(self.value))
+
     def pack(self):
-        upper = bin(self.ticks)[2:].zfill(62)
-        lower = bin(self.tzinfo)[2:].zfill(2)
-        return binascii.unhexlify('{:0>16x}'.format(int(upper + lower, 2)))
+        return self.value.encode('utf-8')
 
     @classmethod
     def unpack(cls, byts):
-        bindata = bin(int(binascii.hexlify(byts[:8]), 16))[2:].zfill(64)
-        ticks = int(bindata[:62], 2)
-        tzinfo = int(bindata[62:], 2)
-        return cls(ticks, tzinfo)
+        b = ord(byts[0])
+        if b < 0x80:
+            length = 1
+        elif b < 0xe0:
+            length = 2
+        elif b < 0xf0:
+            length = 3
+        else:
+            length = 4
+        return cls(byts[:length].decode('utf-8'))
+
+
+class Decimal(LengthPrefixedString):
+    '''
+    A decimal number packed as a length prefixed string.
+    '''
+    enum = primitive_type.DECIMAL
+
+    def __repr__(self):
+        return '<Decimal({})>'.format(self.value)
+
+
+class Null(PrimitiveType):
+    '''
+    The Null primitive type has no value bytes.
+    '''
+    enum = primitive_type.NULL
+
+    def __init__(self, value=None):
+        self.value = None
+
+    def __repr__(self):
+        return '<Null()>'
+
+    def pack(self):
+        return b''
+
+    @classmethod
+    def unpack(cls, byts):
+        return cls()
 
 
 _enum = {
     Boolean.enum: Boolean,
-    Single.enum: Single,
+    Byte.enum: Byte,
+    Char.enum: Char,
+    Decimal.enum: Decimal,
+    Double.enum: Double,
+    Int16.enum: Int16,
     Int32.enum: Int32,
     Int64.enum: Int64,
-    UInt64.enum: UInt64,
+    SByte.enum: SByte,
+    Single.enum: Single,
+    TimeSpan.enum: TimeSpan,
     Datetime.enum: Datetime,
+    UInt16.enum: UInt16,
+    UInt32.enum: UInt32,
+    UInt64.enum: UInt64,
+    Null.enum: Null,
     LengthPrefixedString.enum: LengthPrefixedString,
 }
 
 
+# struct formats of the primitive types with a fixed size encoding
+FORMATS = {
+    Boolean.enum: '<B',
+    Byte.enum: '<B',
+    Double.enum: '<d',
+    Int16.enum: '<h',
+    Int32.enum: '<i',
+    Int64.enum: '<q',
+    SByte.enum: '<b',
+    Single.enum: '<f',
+    TimeSpan.enum: '<q',
+    UInt16.enum: '<H',
+    UInt32.enum: '<I',
+    UInt64.enum: '<Q',
+}
+
+
+def primitive(kind, value):
+    if isinstance(value, PrimitiveType):
+        return value
+    if isinstance(kind, primitive_type.PrimitiveTypeEnum):
+        kind = kind.enum
+    if kind == Datetime.enum:
+        if isinstance(value, datetime.datetime):
+            return Datetime.from_datetime(value)
+        return Datetime(value)
+    return _enum[kind](value)
+
+
 def pack_primitive_type(kind, value):
-    return _enum[kind](value).pack()
+    return primitive(kind, value).pack()
 
 
 def unpack_primitive_type(kind, byts):
@@ -2,8 +2,18 @@
 http://stackoverflow.com/questions/3052202/how-to-analyse-contents-of-binary-serialization-stream
 '''
 import binascii
+import collections
 import struct
 import packetview
+from msnrbf.enum.message_enum import MessageEnum
+from msnrbf.enum import binary_type as bt
+from msnrbf.enum import primitive_type as pt
+from msnrbf.types import FORMATS, unpack_length_from
+from msnrbf.structures import value_with_code_encoder
+from msnrbf.records import (
+    SerializationHeader, BinaryMethodCall, MessageEnd
+)
+from msnrbf.grammar import RemotingMessage
 
 
 OP_REQUEST = 0
@@ -61,8 +71,12 @@ class SingleMessage(object):
         return 'SingleMessage({}, {}, {})'.format(
             self.operation_type, self.length, repr(self.headers))
 
-    def pack(self):
-        data = struct.pack(
+    def pack_header(self):
+        '''
+        Pack the preamble and headers, everything in the frame but the
+        message body.
+        '''
+        parts = [struct.pack(
            '<iBBHHi',
            self.protocol_id,
            self.major_version,
@@ -70,12 +84,21 @@ class SingleMessage(object):
            self.operation_type,
            self.content_dist,
            self.length,
-        )
+        )]
         for header in self.headers:
-            data += header.pack()
-        data += struct.pack('<H', 0)
-        data += self.message
-        return data
+            parts.append(header.pack())
+        parts.append(struct.pack('<H', 0))
+        return ''.join(parts)
+
+    def buffers(self):
+        '''
+        The frame as a header buffer and the message body, for sending
+        without copying the body into a combined frame.
+        '''
+        return [self.pack_header(), self.message]
+
+    def pack(self):
+        return self.pack_header() + self.message
 
     @classmethod
     def bytes_needed(cls, byts):
@@ -118,12 +141,7 @@ class SingleMessage(object):
             header, ibyts = cls.consume_header(ibyts)
             if header.header_token == 0:
                 break
-
-            # header_token, ibyts = ibyts[:2], ibyts[2:]
-            # if header_token == '\x00\x00':
-            #     break
-
-            # TODO: Unpack headers
+            headers.append(header)
 
         assert len(ibyts) == length, (len(ibyts), length)
         return cls(operation_type, ibyts, headers=headers)
@@ -142,6 +160,29 @@ class SingleMessage(object):
         return header, byts[len(header_data):]
 
 
+class FrameTemplate(object):
+    '''
+    Frame preamble and headers packed once for frames that only differ in
+    their message body.
+    '''
+
+    def __init__(self, operation_type, headers=None):
+        msg = SingleMessage(operation_type, '', headers=headers)
+        data = msg.pack()
+        self.operation_type = operation_type
+        self.prefix = data[:10]
+        self.headers = data[14:]
+
+    def pack_header(self, length):
+        return self.prefix + struct.pack('<i', length) + self.headers
+
+    def pack(self, message):
+        return self.pack_header(len(message)) + message
+
+    def buffers(self, message):
+        return [self.pack_header(len(message)), message]
+
+
 # Message Headers
 
 
@@ -286,6 +327,175 @@ headers = {
 }
 
 
+# Fast frame inspection
+#
+# The helpers below read the frame preamble, headers and the leading records
+# of the message body in place using struct offsets. They never build header
+# or record objects which makes them cheap enough to run before deciding what
+# to do with a message.
+
+
+PREAMBLE = struct.Struct('<iBBHHi')
+_BYTE = struct.Struct('<B')
+_UINT16 = struct.Struct('<H')
+_UINT32 = struct.Struct('<I')
+_INT32 = struct.Struct('<i')
+_COUNTED_STRING = struct.Struct('<Bi')
+
+# Size of the data following the header token for fixed size headers
+_FIXED_HEADER_SIZES = {
+    StatusCodeHeader.header_token: 3,
+    CloseConnectionHeader.header_token: 1,
+}
+
+# Record types and sizes used when peeking at the message body (MS-NRBF 2.1.2.1)
+_SERIALIZATION_HEADER_RECORD = 0
+_SERIALIZATION_HEADER_SIZE = 17
+_BINARY_LIBRARY_RECORD = 12
+_BINARY_METHOD_CALL_RECORD = 21
+_STRING_CODE = 18
+
+
+class IncompleteFrame(Exception):
+    pass
+
+
+CallInfo = collections.namedtuple(
+    'CallInfo', ['uri', 'type_name', 'method_name', 'message_enum']
+)
+
+
+class FrameInfo(object):
+    '''
+    Location of the parts of a single message frame.
+
+    body_offset is the offset of the first byte of the message body and
+    length is the size of the body in bytes.
+    '''
+
+    def __init__(self, operation_type, length, body_offset, uri=None,
+                 content_type=None):
+        self.operation_type = operation_type
+        self.length = length
+        self.body_offset = body_offset
+        self.uri = uri
+        self.content_type = content_type
+
+    def __repr__(self):
+        return 'FrameInfo({}, {}, {}, {})'.format(
+            self.operation_type, self.length, self.body_offset, self.uri)
+
+    @property
+    def frame_length(self):
+        return self.body_offset + self.length
+
+
+def _tobytes(byts):
+    if isinstance(byts, memoryview):
+        return byts.tobytes()
+    return bytes(byts)
+
+
+# CountedString StringEncoding values, 0 is UTF-16 and 1 is UTF-8
+_STRING_ENCODINGS = {0: 'utf-16-le', 1: 'utf-8'}
+
+
+def _read_counted_string(byts, offset):
+    string_encoding, length = _COUNTED_STRING.unpack_from(byts, offset)
+    if string_encoding not in _STRING_ENCODINGS:
+        raise Exception("Unsupported string encoding: {}".format(string_encoding))
+    start = offset + _COUNTED_STRING.size
+    end = start + length
+    if end > len(byts):
+        raise IncompleteFrame()
+    encoding = _STRING_ENCODINGS[string_encoding]
+    return _tobytes(byts[start:end]).decode(encoding), end
+
+
+def _read_lps(byts, offset):
+    length, start = unpack_length_from(byts, offset)
+    end = start + length
+    if end > len(byts):
+        raise IncompleteFrame()
+    return _tobytes(byts[start:end]).decode('utf-8'), end
+
+
+def peek_frame(byts):
+    '''
+    Read the preamble and headers of the frame at the start of byts. Returns
+    a FrameInfo, or None when byts does not yet contain all of the headers.
+    The message body does not need to be present.
+    '''
+    try:
+        return _peek_frame(byts)
+    except (struct.error, IncompleteFrame):
+        return None
+
+
+def _peek_frame(byts):
+    protocol_id, major, minor, operation_type, content_dist, length = \
+        PREAMBLE.unpack_from(byts, 0)
+    if protocol_id != SingleMessage.protocol_id:
+        raise Exception("Invalid protocol id: {}".format(protocol_id))
+    if (major, minor) != (SingleMessage.major_version, SingleMessage.minor_version):
+        raise Exception("Unsupported version: {}.{}".format(major, minor))
+    if length < 0:
+        raise Exception("Invalid content length: {}".format(length))
+    uri = content_type = None
+    offset = PREAMBLE.size
+    while True:
+        header_token, = _UINT16.unpack_from(byts, offset)
+        offset += _UINT16.size
+        if header_token == EndHeader.header_token:
+            break
+        if header_token in _FIXED_HEADER_SIZES:
+            offset += _FIXED_HEADER_SIZES[header_token]
+            continue
+        if header_token not in headers:
+            raise Exception("Invalid header token: {}".format(header_token))
+        # Remaining headers are a data type followed by a CountedString
+        value, offset = _read_counted_string(byts, offset + 1)
+        if header_token == RequestUriHeader.header_token:
+            uri = value
+        elif header_token == ContentTypeHeader.header_token:
+            content_type = value
+    if offset > len(byts):
+        raise IncompleteFrame()
+    return FrameInfo(operation_type, length, offset, uri, content_type)
+
+
+def peek_call(byts):
+    '''
+    Read the request uri, type name, method name and message enum of a method
+    call frame without decoding the call arguments. Returns a CallInfo or None
+    when the frame does not contain a method call.
+    '''
+    frame = _peek_frame(byts)
+    offset = frame.body_offset
+    record_type, = _BYTE.unpack_from(byts, offset)
+    if record_type != _SERIALIZATION_HEADER_RECORD:
+        return None
+    offset += _SERIALIZATION_HEADER_SIZE
+    record_type, = _BYTE.unpack_from(byts, offset)
+    if record_type == _BINARY_LIBRARY_RECORD:
+        length, offset = unpack_length_from(byts, offset + 5)
+        offset += length
+        record_type, = _BYTE.unpack_from(byts, offset)
+    if record_type != _BINARY_METHOD_CALL_RECORD:
+        return None
+    word, = _UINT32.unpack_from(byts, offset + 1)
+    offset += 5
+    names = []
+    for _ in range(2):
+        code, = _BYTE.unpack_from(byts, offset)
+        if code != _STRING_CODE:
+            raise Exception("Invalid string value code: {}".format(code))
+        name, offset = _read_lps(byts, offset + 1)
+        names.append(name)
+    method_name, type_name = names
+    return CallInfo(frame.uri, type_name, method_name, MessageEnum.fromword(word))
+
+
 class RemotingRequest(object):
 
     def __init__(self, message, response=None):
@@ -300,17 +510,245 @@ class RemotingResponse(object):
         self.message = message
 
 
+class RequestTemplate(object):
+    '''
+    The invariant bytes of a method call frame. Everything but the frame
+    length and the encoded arguments is packed once, a request is the head,
+    the length, the middle, the arguments and the tail.
+
+    Calls passing their arguments in a call array have no fixed message body
+    prefix, pack_body frames a complete message body instead.
+    '''
+
+    def __init__(self, uri, type_name, method_name, content_type,
+                 message_enum, operation_type=OP_REQUEST):
+        frame = FrameTemplate(
+            operation_type,
+            headers=[RequestUriHeader(uri), ContentTypeHeader(content_type)]
+        )
+        self.operation_type = operation_type
+        self.head = frame.prefix
+        self.headers = frame.headers
+        self.body_prefix = (
+            SerializationHeader(0, 0, 0).pack() +
+            BinaryMethodCall(message_enum, method_name, type_name).pack()
+        )
+        self.middle = frame.headers + self.body_prefix
+        self.tail = MessageEnd().pack()
+        self.fixed_length = len(self.body_prefix) + len(self.tail)
+
+    def body(self, args):
+        return self.body_prefix + args + self.tail
+
+    def parts(self, args):
+        '''
+        The buffers of a request frame around already encoded arguments.
+        '''
+        return (
+            self.head, _INT32.pack(self.fixed_length + len(args)),
+            self.middle, args, self.tail
+        )
+
+    def pack(self, args):
+        '''
+        Pack a request frame around already encoded arguments.
+        '''
+        return b''.join(self.parts(args))
+
+    def pack_body(self, body):
+        return b''.join((self.head, _INT32.pack(len(body)), self.headers, body))
+
+
+class ReplyTemplate(object):
+    '''
+    A reply frame encoded once from a prototype return value, with the
+    offsets of some of its fixed size primitive members. Replies that only
+    differ in those members are a copy of the frame with the new values
+    packed in place.
+
+    fields is a list of member paths from the return value, a path is a
+    dotted string of attribute names such as 'info.culture'. Members of
+    system classes encoded only once because an equal object was encoded
+    before them can not be patched.
+    '''
+
+    def __init__(self, value, fields):
+        message = RemotingMessage.build_method_return(value=value)
+        offsets = {}
+        offset = 0
+        for record in message.stream():
+            offsets[id(record)] = offset
+            offset += len(record.pack())
+        body = message.pack()
+        header = FrameTemplate(OP_REPLY).pack_header(len(body))
+        self.fields = list(fields)
+        self.slots = []
+        for path in self.fields:
+            record = self._member_record(value, path)
+            kind = record.typ.enum
+            if kind not in FORMATS or id(record) not in offsets:
+                raise Exception("Member {} can not be patched".format(path))
+            self.slots.append(
+                (struct.Struct(FORMATS[kind]), len(header) + offsets[id(record)])
+            )
+        self.data = header + body
+
+    @staticmethod
+    def _member_record(value, path):
+        names = path.split('.')
+        for name in names[:-1]:
+            value = getattr(value, name)
+        for n, (name, member) in enumerate(value._members):
+            if name == names[-1]:
+                if not member._val_is_primitive():
+                    raise Exception("Member {} is not a primitive".format(path))
+                return value._g.refs[n].ref
+        raise Exception("No member {}".format(path))
+
+    def pack(self, values):
+        '''
+        A reply frame with the members in fields set to values.
+        '''
+        data = bytearray(self.data)
+        for (fmt, offset), value in zip(self.slots, values):
+            fmt.pack_into(data, offset, value)
+        return data
+
+
 class RemotingMethod(object):
+    '''
+    A remote method and its compiled request template.
+
+    cache is an optional cache.LRUCache used by clients to keep the results
+    of calls, keyed by the encoded arguments. Only set it for methods whose
+    result depends on their arguments alone.
+
+    Clients collapse concurrent identical calls of idempotent methods into a
+    single request, methods with a cache are always treated as idempotent.
+    '''
 
     def __init__(
             self, uri, serverinfo, methodname, arg_spec, return_spec,
-            content_type='application/octet-stream'):
+            content_type='application/octet-stream',
+            operation_type=OP_REQUEST, cache=None, idempotent=False):
         self.uri = uri
         self.serverinfo = serverinfo
         self.methodname = methodname
         self.arg_spec = arg_spec
         self.return_spec = return_spec
         self.content_type = content_type
+        self.operation_type = operation_type
+        self.cache = cache
+        self.idempotent = idempotent or cache is not None
+        self.compile_args()
+
+    def compile_args(self):
+        '''
+        Pick the argument layout for arg_spec and build its encoder.
+
+        arg_spec is a list of (BinaryTypeEnumeration, PrimitiveTypeEnumeration)
+        pairs, the primitive type is None for anything but primitives.
+        Primitives and strings are passed inline as ValueWithCode structures,
+        which needs no record per argument. A call with any object or array
+        argument passes each of its arguments as an item of the call array
+        (ArgsIsArray).
+        '''
+        self.kinds = []
+        for bspec, pspec in self.arg_spec:
+            if bspec == bt.PRIMITIVE:
+                self.kinds.append(getattr(pspec, 'enum', pspec))
+            else:
+                self.kinds.append(None)
+        self.args_inline = all(
+            bspec in (bt.PRIMITIVE, bt.STRING) for bspec, pspec in self.arg_spec
+        )
+        if not self.arg_spec:
+            message_enum = MessageEnum(NoContext=True, NoArgs=True)
+        elif self.args_inline:
+            message_enum = MessageEnum(NoContext=True, ArgsInline=True)
+        else:
+            message_enum = MessageEnum(NoContext=True, ArgsIsArray=True)
+        self.message_enum = message_enum
+        self.encoders = []
+        if self.args_inline:
+            self.encoders = [
+                value_with_code_encoder(pt.STRING if kind is None else kind)
+                for kind in self.kinds
+            ]
+        self.template = RequestTemplate(
+            self.uri, self.serverinfo, self.methodname, self.content_type,
+            message_enum, self.operation_type
+        )
+
+    def encode_args(self, inputargs):
+        '''
+        Encode the arguments of a call as the inline argument array of the
+        BinaryMethodCall record.
+        '''
+        if not self.arg_spec:
+            return b''
+        if len(inputargs) != len(self.encoders):
+            raise Exception("{} takes {} arguments, got {}".format(
+                self.methodname, len(self.encoders), len(inputargs)
+            ))
+        return _INT32.pack(len(self.encoders)) + b''.join([
+            encode(value) for encode, value in zip(self.encoders, inputargs)
+        ])
+
+    def encode_body(self, inputargs):
+        '''
+        Encode the message body of a call.
+        '''
+        if self.args_inline:
+            return self.template.body(self.encode_args(inputargs))
+        if len(inputargs) != len(self.kinds):
+            raise Exception("{} takes {} arguments, got {}".format(
+                self.methodname, len(self.kinds), len(inputargs)
+            ))
+        method = BinaryMethodCall(
+            self.message_enum, self.methodname, self.serverinfo
+        )
+        return RemotingMessage.build_method_call_array(
+            method, list(inputargs), self.arg_spec
+        ).pack()
+
+    def encode(self, inputargs):
+        '''
+        Encode the variable part of a call, the inline arguments or the whole
+        message body. Equal arguments encode to equal bytes, which makes the
+        result usable as a cache key.
+        '''
+        if self.args_inline:
+            return self.encode_args(inputargs)
+        return self.encode_body(inputargs)
+
+    def pack_encoded(self, encoded):
+        '''
+        Pack a request frame from the result of encode.
+        '''
+        if self.args_inline:
+            return self.template.pack(encoded)
+        return self.template.pack_body(encoded)
+
+    def pack_request(self, inputargs):
+        '''
+        Pack a request frame for a call, the fast path of create_request.
+        '''
+        return self.pack_encoded(self.encode(inputargs))
+
+    def pack_requests(self, arglists):
+        '''
+        Pack a request frame for each list of arguments into one buffer,
+        ready to be written with a single send.
+        '''
+        parts = []
+        if self.args_inline:
+            for inputargs in arglists:
+                parts.extend(self.template.parts(self.encode_args(inputargs)))
+        else:
+            for inputargs in arglists:
+                parts.append(self.template.pack_body(self.encode_body(inputargs)))
+        return b''.join(parts)
 
     def create_request(self, inputargs):
         '''
@@ -341,46 +779,22 @@ class RemotingMethod(object):
         serializing the request and the values for the MessageEnum field of the
         BinaryMethodCall record.
         '''
-        from msnrbf.records import *
-        from msnrbf.grammar import *
-        args = []
-        for n, (bspec, pspec,) in enumerate(self.arg_spec):
-            if bspec == bt.STRING and pspec is None:
-                args.append(
-                    ValueWithCode(
-                        LengthPrefixedString.enum,
-                        inputargs[n],
-                    )
-                )
-        method = BinaryMethodCall(
-            MessageEnum(NoContext=True, ArgsInline=True),
-            self.methodname,
-            self.serverinfo,
-            args=ArrayOfValueWithCode(args),
-        )
-        message_body = RemotingMessage.build_method_call(method)
-        msg = SingleMessage(
-            OP_REQUEST,
-            message_body.pack(),
+        return SingleMessage(
+            self.operation_type,
+            self.encode_body(inputargs),
             headers=[
                 RequestUriHeader(self.uri),
                 ContentTypeHeader(self.content_type)
             ]
         )
-        return msg
 
     def create_response(self, value=None, exception=None):
         '''
         MS-NRTP 3.1.5.1.2 Mapping Remote Method Invocation Reply
         '''
-        from msnrbf.records import *
-        from msnrbf.grammar import *
-        method = BinaryMethodReturn(
-            MessageEnum(ReturnValueInArray=True),
-        )
-        message_body = RemotingMessage.build_metho_return(value, exception)
+        message_body = RemotingMessage.build_method_return(value, exception)
         msg = SingleMessage(
-            OP_REQUEST,
+            OP_REPLY,
             message_body.pack(),
             headers=[
                 RequestUriHeader(self.uri),
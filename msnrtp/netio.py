@@ -0,0 +1,145 @@
+'''
+Socket helpers for reading and writing MS-NRTP frames.
+'''
+import select
+import socket
+from msnrtp import peek_frame
+
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Without sendmsg, buffers adding up to at most this many bytes are joined and
+# sent with a single call. Copying a few small buffers is cheaper than the
+# extra system calls, and on sockets without TCP_NODELAY avoids a small header
+# segment being held back waiting for an ack.
+JOIN_THRESHOLD = 65536
+
+
+def join_buffers(buffers):
+    return b''.join(
+        buf.tobytes() if isinstance(buf, memoryview) else bytes(buf)
+        for buf in buffers
+    )
+
+
+def sendall_buffers(sock, buffers):
+    '''
+    Send a sequence of buffers without joining them. When the platform
+    supports it the buffers are written with sendmsg scatter/gather, otherwise
+    small buffers are joined and large ones written with sendall one by one.
+    '''
+    if not HAS_SENDMSG:
+        if sum(len(buf) for buf in buffers) <= JOIN_THRESHOLD:
+            sock.sendall(join_buffers(buffers))
+            return
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    buffers = [memoryview(buf) for buf in buffers if len(buf)]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def closed_by_peer(sock):
+    '''
+    True when the peer closed an idle connection. Only call this between
+    frames, pending data is taken to mean the connection is still open.
+    '''
+    readable, writeable, exceptional = select.select([sock], [], [], 0)
+    if not readable:
+        return False
+    try:
+        return not sock.recv(1, socket.MSG_PEEK)
+    except socket.error:
+        return True
+
+
+class RecvBuffer(object):
+    '''
+    A receive buffer reused for every frame read from one connection.
+
+    Data is received straight into a bytearray with recv_into. Once a frame's
+    headers are in, the buffer is grown to hold the whole frame so the body
+    is received without further copies or allocations. Bytes read past the
+    end of a frame are kept for the next one, unread data is moved to the
+    front of the buffer only when the free space at the end runs out.
+    '''
+
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.start = 0  # First byte not yet returned in a frame
+        self.end = 0  # End of the received data
+
+    def __len__(self):
+        return self.end - self.start
+
+    def view(self):
+        return memoryview(self.buf)[self.start:self.end]
+
+    def reserve(self, size):
+        '''
+        Make room for at least size bytes of unread data.
+        '''
+        if len(self.buf) - self.start >= size:
+            return
+        pending = self.end - self.start
+        if len(self.buf) >= size:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        else:
+            buf = bytearray(max(size, 2 * len(self.buf)))
+            buf[:pending] = self.buf[self.start:self.end]
+            self.buf = buf
+        self.start = 0
+        self.end = pending
+
+    def fill(self, sock):
+        '''
+        Receive into the free space at the end of the buffer, returns the
+        number of bytes received.
+        '''
+        if self.end == len(self.buf):
+            self.reserve(len(self) + len(self.buf))
+        received = sock.recv_into(memoryview(self.buf)[self.end:])
+        self.end += received
+        return received
+
+    def recv_frame(self, sock, wait=None):
+        '''
+        Read the next frame from sock. Returns a FrameInfo and a memoryview of
+        the frame, or (None, None) when the peer closed the connection between
+        frames. The view is only valid until the next call. wait, when given,
+        is called before each receive, for example to select on a non
+        blocking socket.
+        '''
+        while True:
+            frame, view = self.pop_frame()
+            if frame is not None:
+                return frame, view
+            if wait is not None:
+                wait()
+            if not self.fill(sock):
+                if not len(self):
+                    return None, None
+                raise socket.error("Connection closed before end of frame")
+
+    def pop_frame(self):
+        '''
+        Return the next frame when the buffer holds all of it, otherwise
+        (None, None). The view is only valid until the next call.
+        '''
+        frame = peek_frame(self.view())
+        if frame is None:
+            return None, None
+        if len(self) < frame.frame_length:
+            self.reserve(frame.frame_length)
+            return None, None
+        start = self.start
+        self.start += frame.frame_length
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frame, memoryview(self.buf)[start:start + frame.frame_length]
@@ -0,0 +1,330 @@
+'''
+A MS-NRTP reverse proxy.
+
+Frames are routed to a backend by their RequestUriHeader or by the method
+name of the call. Message bodies are never decoded, the router only reads
+the frame headers and, for method routes, the leading BinaryMethodCall
+record. Frames are relayed from the buffer they were received into.
+'''
+import collections
+import contextlib
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from msnrtp import peek_call
+from netio import (
+    RecvBuffer, JOIN_THRESHOLD, closed_by_peer, join_buffers, sendall_buffers
+)
+from server import Server, uri_path
+
+
+logger = logging.getLogger()
+
+
+class NoRoute(Exception):
+    pass
+
+
+class BackendBusy(Exception):
+    pass
+
+
+class BackendConnection(object):
+    '''
+    A connection to a backend and the buffer replies are received into.
+    bytes_sent counts the bytes written to it.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = RecvBuffer()
+        self.bytes_sent = 0
+
+    def send(self, buffers):
+        '''
+        Send a list of buffers, small ones joined as in sendall_buffers.
+        Unlike sendall, bytes_sent is up to date when a send fails.
+        '''
+        if sum(len(buf) for buf in buffers) <= JOIN_THRESHOLD:
+            buffers = [join_buffers(buffers)]
+        for buf in buffers:
+            view = memoryview(buf)
+            while view:
+                sent = self.sock.send(view)
+                self.bytes_sent += sent
+                view = view[sent:]
+
+    def closed_by_peer(self):
+        return closed_by_peer(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+
+class Backend(object):
+    '''
+    A pool of connections to one backend server. At most max_connections
+    requests are relayed to the backend at once, further requests wait up to
+    acquire_timeout seconds for a connection to become available.
+
+    Set idempotent when every method of the backend is safe to run twice,
+    requests failing on a reused connection are then sent again even when
+    the backend may have received them.
+    '''
+
+    def __init__(self, host, port, max_connections=8, acquire_timeout=None,
+                 timeout=None, idempotent=False):
+        self.host = host
+        self.port = port
+        self.idempotent = idempotent
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def __repr__(self):
+        return 'Backend({}, {})'.format(self.host, self.port)
+
+    def _acquire_slot(self):
+        if self.acquire_timeout is None:
+            return self._semaphore.acquire()
+        # threading semaphores have no timeout in python 2, poll instead.
+        deadline = time.time() + self.acquire_timeout
+        while not self._semaphore.acquire(False):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return BackendConnection(sock)
+
+    def _pop_idle(self):
+        '''
+        Return an idle connection, idle connections the backend has closed
+        are discarded. Returns None when there are none left.
+        '''
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn = self._idle.pop()
+            if not conn.closed_by_peer():
+                return conn
+            conn.close()
+
+    def _release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        Check a connection out of the pool. Connections are returned to the
+        pool when the block completes and closed if it raised.
+        '''
+        if not self._acquire_slot():
+            raise BackendBusy(self)
+        conn = None
+        try:
+            conn = self._pop_idle()
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        except Exception:
+            if conn is not None:
+                conn.close()
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._release(conn)
+            self._semaphore.release()
+
+    @contextlib.contextmanager
+    def exchange(self, buffers):
+        '''
+        Send a frame, given as a list of buffers, and yield the FrameInfo and
+        a memoryview of the reply. The view points into the connection's
+        receive buffer, the connection is held until the block completes.
+
+        The backend may close an idle connection just as it is reused. A
+        request that fails on a reused connection before any of it was sent
+        is sent once more on a new one. Once sent the backend may have run
+        it, unless the backend is idempotent the error is raised rather than
+        risk running it twice.
+        '''
+        if not self._acquire_slot():
+            raise BackendBusy(self)
+        try:
+            reply = None
+            conn = self._pop_idle()
+            if conn is not None:
+                bytes_sent = conn.bytes_sent
+                try:
+                    reply = self._exchange(conn, buffers)
+                except socket.error:
+                    if conn.bytes_sent != bytes_sent and not self.idempotent:
+                        raise
+                    logger.debug("Pooled connection to %s failed, reconnecting", self)
+            if reply is None:
+                conn = self._connect()
+                reply = self._exchange(conn, buffers)
+            try:
+                yield reply
+            finally:
+                self._release(conn)
+        finally:
+            self._semaphore.release()
+
+    def _exchange(self, conn, buffers):
+        try:
+            conn.send(buffers)
+            frame, view = conn.buffer.recv_frame(conn.sock)
+            if frame is None:
+                raise socket.error("Backend closed connection: {}".format(self))
+        except Exception:
+            conn.close()
+            raise
+        return frame, view
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class IdleConnections(object):
+    '''
+    Client connections waiting for their next request, watched with poll by
+    one thread so they do not hold a worker. Once a connection has data to
+    read, or is closed, it is no longer watched and ready(conn, addr, buf) is
+    called on the watching thread, ready must not block.
+    '''
+
+    def __init__(self, ready):
+        self.ready = ready
+        self._added = collections.deque()
+        self._conns = {}
+        self._wake_r, self._wake_w = os.pipe()
+        # Only the watching thread touches the poll object
+        self._poll = select.poll()
+        self._poll.register(self._wake_r, select.POLLIN)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, conn, addr, buf):
+        self._added.append((conn, addr, buf))
+        os.write(self._wake_w, b'\x00')
+
+    def _run(self):
+        while True:
+            for fd, event in self._poll.poll():
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    while self._added:
+                        entry = self._added.popleft()
+                        self._conns[entry[0].fileno()] = entry
+                        self._poll.register(entry[0], select.POLLIN)
+                    continue
+                entry = self._conns.pop(fd, None)
+                if entry is None:
+                    continue
+                self._poll.unregister(fd)
+                try:
+                    self.ready(*entry)
+                except Exception:
+                    logger.exception("Unable to resume connection from %s", entry[1])
+                    entry[0].close()
+
+
+class Router(Server):
+    '''
+    Relay frames to backends.
+
+    A client connection holds a worker only while its frames are relayed.
+    Between requests it waits with the idle connections, so pooled client
+    connections do not use up the workers.
+
+    backends      Mapping of backend name to Backend
+    uri_routes    Mapping of request uri path (for example '/Security.rem') to
+                  backend name
+    method_routes Mapping of method name to backend name, takes precedence over
+                  uri_routes
+    default       Name of the backend used when no route matches
+    '''
+    _max_workers = 32
+    _listen_queue = 64
+
+    def __init__(self, backends, uri_routes=None, method_routes=None,
+                 default=None, _sock=None, _executor=None):
+        super(Router, self).__init__(_sock, _executor)
+        self.idle = IdleConnections(self.resume)
+        self.backends = backends
+        self.uri_routes = uri_routes or {}
+        self.method_routes = method_routes or {}
+        self.default = default
+
+    def route(self, frame, data):
+        '''
+        Return the backend for a frame.
+        '''
+        if self.method_routes:
+            call = peek_call(data)
+            if call and call.method_name in self.method_routes:
+                return self.backends[self.method_routes[call.method_name]]
+        path = uri_path(frame.uri)
+        if path in self.uri_routes:
+            return self.backends[self.uri_routes[path]]
+        if self.default is None:
+            raise NoRoute(frame.uri)
+        return self.backends[self.default]
+
+    def resume(self, conn, addr, buf):
+        '''
+        Hand an idle client connection with data to read back to a worker.
+        '''
+        if self.admission.try_submit(self.client_future, conn, addr, buf) is None:
+            self.count('shed')
+            self.shed(conn, addr)
+
+    def handle_client_connection(self, conn, addr, buf=None):
+        '''
+        Relay the next frame from a client, and any further frames already
+        received, then leave the connection with the idle connections until
+        the client sends more. Returns True when the connection was kept.
+        '''
+        if buf is None:
+            buf = RecvBuffer()
+        frame, data = buf.recv_frame(conn)
+        if frame is None:
+            return False
+        while frame is not None:
+            try:
+                backend = self.route(frame, data)
+                self.relay(conn, backend, data)
+            except Exception:
+                logger.exception("Unable to relay request from %s", addr)
+                self.error_reply(conn, data)
+                return False
+            frame, data = buf.pop_frame()
+        self.idle.add(conn, addr, buf)
+        return True
+
+    def relay(self, conn, backend, data):
+        '''
+        Send a frame to a backend and its reply to the client connection.
+        The reply is sent straight from the backend connection's receive
+        buffer.
+        '''
+        with backend.exchange([data]) as (reply_frame, reply):
+            sendall_buffers(conn, [reply])
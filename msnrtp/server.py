@@ -1,9 +1,23 @@
+import heapq
+import itertools
 import logging
+import pickle
 import socket
-from concurrent.futures import ThreadPoolExecutor
-from msnrtp import SingleMessage, OP_REPLY
-from msnrbf.records import BinaryMethodCall
+import sys
+import threading
+import time
+import urlparse
+from concurrent.futures import (
+    Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+)
+from msnrtp import FrameTemplate, OP_REPLY, peek_call, peek_frame
+from decode import decode_message
+from netio import RecvBuffer, sendall_buffers
+from cache import SingleFlight, MISSING
 from msnrbf.grammar import RemotingMessage
+from msnrbf.scanner import inline_args
+from msnrbf.enum import binary_type as bt
+from msnrbf.enum import primitive_type as pt
 import packetview
 from system_classes import RemotingException
 from msnrbf.records import (
@@ -16,9 +30,310 @@ from msnrbf.enum.message_enum import MessageEnum
 logger = logging.getLogger()
 
 
+REPLY_FRAME = FrameTemplate(OP_REPLY)
+
+# Handler execution policies
+INLINE = 'inline'    # In the thread handling the connection
+THREAD = 'thread'    # In the server's handler thread pool
+PROCESS = 'process'  # In the server's handler process pool
+
+# Python 2 does not define SO_REUSEPORT, the value is the same on all linux
+# architectures we run on.
+SO_REUSEPORT = getattr(
+    socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None
+)
+
+
+class NoHandler(Exception):
+    pass
+
+
+def bind_socket(addr, port, reuse_port=False):
+    '''
+    Create a tcp socket bound to addr and port. With reuse_port several
+    sockets, in one or more processes, can bind the same address.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise Exception("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((addr, port))
+    return sock
+
+
+def uri_path(uri):
+    '''
+    The path of a request uri, 'tcp://host:8080/Service.rem' and
+    '/Service.rem' both become '/Service.rem'.
+    '''
+    if uri and '://' in uri:
+        return urlparse.urlparse(uri).path
+    return uri
+
+
+def short_type_name(type_name):
+    '''
+    Strip the assembly information from an assembly qualified type name.
+    '''
+    if type_name:
+        return type_name.split(',', 1)[0].strip()
+    return type_name
+
+
+def decode_call_args(data):
+    '''
+    Decode the arguments of a method call frame.
+    '''
+    return decode_message(data).args
+
+
+class ArgsDecoder(object):
+    '''
+    The argument decoder of one handler, built when the handler is created.
+
+    Inline arguments are read straight from the method call record without
+    building any records, calls passing their arguments in a call array are
+    decoded in full. With an arg_spec, a list of (binary type, primitive type)
+    pairs as taken by RemotingMethod, the number and types of inline
+    arguments are checked against it.
+    '''
+
+    def __init__(self, arg_spec=None):
+        self.kinds = None
+        if arg_spec is not None:
+            self.kinds = [
+                pt.STRING if binary_type == bt.STRING else kind
+                for binary_type, kind in arg_spec
+            ]
+
+    def __call__(self, data):
+        args = inline_args(data, peek_frame(data).body_offset, self.kinds)
+        if args is None:
+            return decode_call_args(data)
+        return args
+
+
+def encode_method_return(value):
+    '''
+    Encode a return value into a reply frame, returned as the frame header
+    and message body buffers so the body is sent without being copied.
+    '''
+    return REPLY_FRAME.buffers(
+        RemotingMessage.build_method_return(value=value).pack()
+    )
+
+
+def encode_exception(exception):
+    '''
+    Encode an exception into a reply frame.
+    '''
+    return REPLY_FRAME.pack(
+        RemotingMessage.build_method_return(exception=exception).pack()
+    )
+
+
+def _remoting_exception(message=None):
+    exception = RemotingException()
+    exception.message = message
+    return exception
+
+
+# Replies that never change are encoded once
+ERROR_REPLY = encode_exception(_remoting_exception())
+BUSY_REPLY = encode_exception(_remoting_exception('Server is busy'))
+TIMEOUT_REPLY = encode_exception(_remoting_exception('Request timed out'))
+
+
+def reply_cache_key(data):
+    '''
+    The message body of a request frame, it holds the method and the
+    encoded arguments.
+    '''
+    return data[peek_frame(data).body_offset:]
+
+
+def reply_size(reply):
+    if isinstance(reply, list):
+        return sum(len(buf) for buf in reply)
+    return len(reply)
+
+
+class BoundedExecutor(object):
+    '''
+    Limits the number of tasks running and queued on an executor. Once
+    max_pending tasks are pending try_submit refuses new ones instead of
+    queuing them. A max_pending of None does not limit the executor.
+    '''
+
+    def __init__(self, executor, max_pending=None):
+        self.executor = executor
+        self.max_pending = max_pending
+        self._slots = None
+        if max_pending:
+            self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _release(self, future):
+        self._slots.release()
+
+    def try_submit(self, fn, *args, **kwargs):
+        '''
+        Submit fn to the executor, returns None if the executor is full.
+        '''
+        if self._slots is None:
+            return self.executor.submit(fn, *args, **kwargs)
+        if not self._slots.acquire(False):
+            return None
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+
+class PriorityExecutor(object):
+    '''
+    A pool of threads running tasks in priority order, lower values first,
+    tasks of equal priority run in submission order.
+
+    With aging set, waiting counts towards a task's priority. A task is
+    ordered as if it was submitted priority * aging seconds later than it
+    actually was, so a task never waits for more than aging seconds per
+    priority class behind tasks submitted after it.
+    '''
+
+    def __init__(self, max_workers, aging=None):
+        self.max_workers = max_workers
+        self.aging = aging
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _key(self, priority):
+        if self.aging:
+            return (time.time() + priority * self.aging, next(self._seq))
+        return (priority, next(self._seq))
+
+    def submit(self, priority, fn, *args, **kwargs):
+        future = Future()
+        with self._cond:
+            heapq.heappush(
+                self._queue, (self._key(priority), future, fn, args, kwargs)
+            )
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, future, fn, args, kwargs = heapq.heappop(self._queue)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class Handler(object):
+    '''
+    A remote method implementation.
+
+    The key is the (request uri path, short type name, method name) the handler
+    is registered under, a None uri or type name matches any value. The
+    argument decoder turns a request frame into the positional arguments of
+    func, by default it is an ArgsDecoder built from arg_spec. The return
+    encoder turns the value returned by func into a reply frame, either as a
+    string or as a list of buffers.
+
+    The execution policy selects where the handler runs, one of INLINE, THREAD
+    or PROCESS. Process handlers receive the raw request frame in the worker
+    process and return the encoded reply so decoding, the call and encoding
+    all happen outside of the server process. The handler, including func and
+    its decoder and encoder, has to be picklable.
+
+    When pool names one of the server's worker pools the handler runs in that
+    pool, see Server.add_pool.
+
+    A request not answered within timeout seconds of being read gets the
+    timeout reply. Inline handlers with a timeout run in the handler thread
+    pool so the connection thread can stop waiting for them. Python threads
+    can not be interrupted, a handler already running past its timeout is
+    abandoned and runs to completion in its worker.
+
+    Concurrent byte identical requests for an idempotent handler, same
+    request uri and same message body, are run once and every connection
+    gets the same reply.
+
+    With a reply_cache, a cache.LRUCache, encoded replies are cached by
+    message body. A cached reply is sent without running the handler or
+    encoding anything, only use it for handlers whose result depends on
+    their arguments alone. Server.invalidate_replies empties the caches.
+    '''
+
+    def __init__(self, func, uri=None, type_name=None, method_name=None,
+                 decode_args=None, encode_return=encode_method_return,
+                 execution=INLINE, pool=None, timeout=None, idempotent=False,
+                 reply_cache=None, arg_spec=None):
+        if execution not in (INLINE, THREAD, PROCESS):
+            raise Exception("Invalid execution policy: {}".format(execution))
+        self.func = func
+        self.uri = uri_path(uri)
+        self.type_name = short_type_name(type_name)
+        self.method_name = method_name or func.__name__
+        if decode_args is None:
+            decode_args = ArgsDecoder(arg_spec)
+        self.decode_args = decode_args
+        self.encode_return = encode_return
+        self.execution = execution
+        self.pool = pool
+        self.timeout = timeout
+        self.idempotent = idempotent
+        self.reply_cache = reply_cache
+
+    def __repr__(self):
+        return 'Handler({}, {}, {})'.format(*self.key)
+
+    def __getstate__(self):
+        # Process handlers are pickled into the worker processes, the reply
+        # cache is only used by the server and holds locks that do not pickle.
+        state = dict(self.__dict__)
+        state['reply_cache'] = None
+        return state
+
+    @property
+    def key(self):
+        return (self.uri, self.type_name, self.method_name)
+
+    def __call__(self, data):
+        '''
+        Run the handler for a request frame and return the reply frame.
+        '''
+        return self.encode_return(self.func(*self.decode_args(data)))
+
+
 class Server(object):
     _max_workers = 2
     _listen_queue = 1
+    _max_pending = 64  # Connections running or queued before shedding load
+    _handler_workers = 4
+    _process_workers = None  # One per cpu
+    _priority_workers = 4
+    _priority_max_pending = 256
+    _priority_aging = None  # Seconds per priority class, see PriorityExecutor
+    _recv_bufsize = 4096
 
     def __init__(self, _sock=None, _executor=None):
         self.sock = _sock
@@ -26,80 +341,358 @@ class Server(object):
             self.executor = _executor
         else:
             self.executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        self.admission = BoundedExecutor(self.executor, self._max_pending)
+        self.handlers = {}
+        self.pools = {}
+        self.uri_pools = {}
+        self.scheduler = None
+        self.method_priorities = {}
+        self.uri_priorities = {}
+        self._thread_executor = None
+        self._process_executor = None
+        self.single_flight = SingleFlight()
+        self.stats = {
+            'connections': 0, 'requests': 0, 'errors': 0, 'shed': 0,
+            'timeouts': 0, 'cached': 0,
+        }
+        self._stats_lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + n
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['coalesced'] = self.single_flight.get_stats()['shared']
+        return stats
+
+    @property
+    def thread_executor(self):
+        if self._thread_executor is None:
+            self._thread_executor = ThreadPoolExecutor(
+                max_workers=self._handler_workers
+            )
+        return self._thread_executor
+
+    @property
+    def process_executor(self):
+        if self._process_executor is None:
+            self._process_executor = ProcessPoolExecutor(
+                max_workers=self._process_workers
+            )
+        return self._process_executor
+
+    def add_pool(self, name, max_workers, max_pending=None, uris=()):
+        '''
+        Add a named worker pool. Requests for the given uris, and for handlers
+        created with this pool name, run in the pool rather than on the
+        connection thread. Once max_pending requests are running or queued in
+        the pool further requests get the busy reply, so a saturated pool
+        never holds up requests served by other pools.
+        '''
+        if name in self.pools:
+            raise Exception("Pool already exists: {}".format(name))
+        self.pools[name] = BoundedExecutor(
+            ThreadPoolExecutor(max_workers=max_workers), max_pending
+        )
+        for uri in uris:
+            self.uri_pools[uri_path(uri)] = name
+        return self.pools[name]
+
+    def set_priority(self, priority, uris=(), methods=()):
+        '''
+        Assign a priority class to request uris and method names, lower
+        values are served first. Requests with a priority class are run by
+        the server's priority scheduler. A method's priority takes precedence
+        over its uri's.
+        '''
+        if self.scheduler is None:
+            self.scheduler = BoundedExecutor(
+                PriorityExecutor(self._priority_workers, self._priority_aging),
+                self._priority_max_pending
+            )
+        for uri in uris:
+            self.uri_priorities[uri_path(uri)] = priority
+        for method_name in methods:
+            self.method_priorities[method_name] = priority
+
+    def find_priority(self, request):
+        if request.method_name in self.method_priorities:
+            return self.method_priorities[request.method_name]
+        return self.uri_priorities.get(uri_path(request.uri))
+
+    def add_handler(self, handler):
+        if handler.key in self.handlers:
+            raise Exception("Handler already registered: {}".format(handler))
+        if handler.pool is not None and handler.pool not in self.pools:
+            raise Exception("No such pool: {}".format(handler.pool))
+        if handler.execution == PROCESS:
+            # Fail at registration rather than on the first request
+            pickle.dumps(handler, pickle.HIGHEST_PROTOCOL)
+        self.handlers[handler.key] = handler
+        return handler
+
+    def register(self, uri=None, type_name=None, method_name=None, **kwargs):
+        '''
+        Decorator registering a function as the handler of a remote method,
+        additional keyword arguments are passed to Handler.
+
+            @server.register('/Security.rem', 'Security.ISecurityQuery')
+            def GetUser(name):
+                ...
+        '''
+        def decorator(func):
+            self.add_handler(
+                Handler(func, uri, type_name, method_name, **kwargs)
+            )
+            return func
+        return decorator
+
+    def find_handler(self, call):
+        '''
+        Find the handler for a CallInfo. The most specific registration wins.
+        '''
+        uri = uri_path(call.uri)
+        type_name = short_type_name(call.type_name)
+        method_name = call.method_name
+        for key in (
+                (uri, type_name, method_name),
+                (None, type_name, method_name),
+                (uri, None, method_name),
+                (None, None, method_name)):
+            if key in self.handlers:
+                return self.handlers[key]
+
+    def invalidate_replies(self, uri=None, type_name=None, method_name=None):
+        '''
+        Empty the reply caches of the handlers matching the given uri, type
+        name and method name, all handlers by default.
+        '''
+        uri = uri_path(uri)
+        type_name = short_type_name(type_name)
+        for handler in self.handlers.values():
+            if handler.reply_cache is None:
+                continue
+            if ((uri is None or handler.uri == uri) and
+                    (type_name is None or handler.type_name == type_name) and
+                    (method_name is None or handler.method_name == method_name)):
+                handler.reply_cache.clear()
 
     def run(self, addr, port):
         '''
         Listen for tcp connections.
         '''
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((addr, port))
-        self.sock.listen(self._listen_queue)
-        futures = []
+        self.serve(self.listen(addr, port))
+
+    def listen(self, addr, port, reuse_port=False):
+        '''
+        Create the listening socket. With reuse_port several processes can
+        bind the same address and the kernel balances connections between
+        them.
+        '''
+        sock = bind_socket(addr, port, reuse_port)
+        sock.listen(self._listen_queue)
+        self.sock = sock
+        return sock
+
+    def serve(self, sock):
+        '''
+        Accept connections from a listening socket forever.
+        '''
+        self.sock = sock
         while True:
-            conn, addr = self.sock.accept()
+            conn, addr = sock.accept()
             logger.debug("connection from: %s", addr)
-            f = self.executor.submit(self.client_future, conn, addr)
-            for future in futures:
-                if f.done():
-                    try:
-                        f.result()
-                    except:
-                        logger.exception('Exception in future')
-
-    def client_future(self, conn, addr):
+            self.count('connections')
+            if self.admission.try_submit(self.client_future, conn, addr) is None:
+                self.count('shed')
+                self.shed(conn, addr)
+
+    def shed(self, conn, addr):
+        '''
+        Reject a connection with the busy reply rather than queuing it. This
+        runs on the accept thread so it must never block.
+        '''
+        logger.debug("shedding connection from: %s", addr)
         try:
-            self.handle_client_connection(conn, addr)
+            conn.setblocking(0)
+            # Read what the client has sent so far, closing a socket with
+            # unread data resets the connection and may discard the reply.
+            try:
+                for _ in range(4):
+                    if not conn.recv(65536):
+                        break
+            except socket.error:
+                pass
+            conn.sendall(BUSY_REPLY)
+        except socket.error:
+            logger.debug("unable to send busy reply to: %s", addr)
         finally:
-            logger.debug('clossing connection from: %s', addr)
             conn.close()
 
+    def client_future(self, conn, addr, *args):
+        # A true result from handle_client_connection means the connection
+        # was handed off to a worker pool which will close it.
+        detached = False
+        try:
+            detached = self.handle_client_connection(conn, addr, *args)
+        except Exception:
+            logger.exception('Exception in future')
+        finally:
+            if not detached:
+                logger.debug('clossing connection from: %s', addr)
+                conn.close()
+
     def handle_client_connection(self, conn, addr):
         '''
         Read all the data from an incomming connection, then run the request
         handler in a threaded future.
         '''
-        data = conn.recv(1024)
-        if not data:
+        frame, view = RecvBuffer(self._recv_bufsize).recv_frame(conn)
+        if frame is None:
             return
-        needed = SingleMessage.bytes_needed(data)
-        while needed > 0:
-            logger.info('need more bytes: {}'.format(d))
-            chunk = conn.recv(needed)
-            needed = needed - len(chunk)
-            data += chunk
-        packetview.view(data)
+        data = view.tobytes()
+        if logger.isEnabledFor(logging.DEBUG):
+            packetview.view(data)
         logger.info("Received %d bytes", len(data))
-        self.handle_request(conn, data)
+        return self.handle_request(conn, data)
 
     def handle_request(self, conn, data):
         '''
         Handle a request.
+
+        Only the frame headers and the method call record are read before
+        dispatching, decoding the arguments is left to the dispatcher.
         '''
         logger.info("Handle request: %s", repr(data[:1024]))
-        msg = SingleMessage.unpack(data)
-        rm = RemotingMessage.unpack(msg.message)
-        if isinstance(rm.method.method, BinaryMethodCall):
-                request = rm.metho.method
-        if not request:
+        try:
+            call = peek_call(data)
+        except Exception:
+            logger.exception("Unable to read method call")
+            call = None
+        if not call:
             logger.info("No method found in request")
             return self.error_reply(conn, data)
-        logger.info("Found request: %s", request)
+        logger.info("Found request: %s", call)
+        self.count('requests')
         try:
-            self.dispatch_request(conn, data, request)
+            return self.dispatch_request(conn, data, call)
         except Exception as e:
             logger.exception("exception while handling request")
+            self.count('errors')
             self.error_reply(conn, data)
             return
         # conn.sendall('\x00' * 1024)
 
     def dispatch_request(self, conn, data, request):
-        raise Exception
+        '''
+        Dispatch a request, request is the CallInfo returned by peek_call.
+        Returns True when the connection was handed off to a worker pool.
+        '''
+        handler = self.find_handler(request)
+        if handler is None:
+            raise NoHandler(request)
+        if handler.reply_cache is not None:
+            reply = handler.reply_cache.get(reply_cache_key(data))
+            if reply is not MISSING:
+                self.count('cached')
+                self.send_reply(conn, reply)
+                return False
+        deadline = None
+        if handler.timeout is not None:
+            deadline = time.time() + handler.timeout
+        pool = self.find_pool(request, handler)
+        if pool is not None:
+            future = pool.try_submit(
+                self.pooled_request, conn, data, handler, deadline
+            )
+        else:
+            priority = self.find_priority(request)
+            if priority is None:
+                self.send_reply(conn, self.run_handler(handler, data, deadline))
+                return False
+            future = self.scheduler.try_submit(
+                priority, self.pooled_request, conn, data, handler, deadline
+            )
+        if future is None:
+            self.count('shed')
+            conn.sendall(BUSY_REPLY)
+            return False
+        return True
+
+    def find_pool(self, request, handler):
+        '''
+        The worker pool for a request, a handler's own pool takes precedence
+        over the pool of the request uri.
+        '''
+        name = handler.pool
+        if name is None:
+            name = self.uri_pools.get(uri_path(request.uri))
+        if name is not None:
+            return self.pools[name]
+
+    def pooled_request(self, conn, data, handler, deadline=None):
+        try:
+            self.send_reply(conn, self.run_handler(handler, data, deadline))
+        except Exception:
+            logger.exception("exception while handling request")
+            self.count('errors')
+            self.error_reply(conn, data)
+        finally:
+            conn.close()
+
+    def run_handler(self, handler, data, deadline=None):
+        '''
+        Run a handler according to its execution policy and return the reply.
+        Past the deadline the timeout reply is returned instead, a request
+        still queued when its deadline passes is never run.
+        '''
+        if handler.idempotent:
+            # The whole frame is the key, its headers hold the request uri.
+            reply = self.single_flight.do(
+                data, self._run_handler, handler, data, deadline
+            )
+        else:
+            reply = self._run_handler(handler, data, deadline)
+        if handler.reply_cache is not None and reply is not TIMEOUT_REPLY:
+            key = reply_cache_key(data)
+            handler.reply_cache.put(key, reply, len(key) + reply_size(reply))
+        return reply
+
+    def _run_handler(self, handler, data, deadline=None):
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return self.timeout_reply(handler)
+        if handler.execution == PROCESS:
+            future = self.process_executor.submit(handler, data)
+        elif handler.execution == THREAD or timeout is not None:
+            future = self.thread_executor.submit(handler, data)
+        else:
+            return handler(data)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            return self.timeout_reply(handler)
+
+    def send_reply(self, conn, reply):
+        if isinstance(reply, list):
+            sendall_buffers(conn, reply)
+        else:
+            conn.sendall(reply)
+
+    def timeout_reply(self, handler):
+        logger.warning("Handler timed out: %s", handler)
+        self.count('timeouts')
+        return TIMEOUT_REPLY
 
     def error_reply(self, conn, data):
         try:
             logger.info("Send error response")
-            rm = RemotingMessage.build_method_return(exception=RemotingException())
-            conn.sendall(rm.pack())
+            conn.sendall(ERROR_REPLY)
         except:
             logger.exception("Exception durring error handling")
 
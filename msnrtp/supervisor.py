@@ -0,0 +1,180 @@
+'''
+Run a Server in several worker processes.
+
+Each worker runs its own accept loop and executors. Workers either bind the
+same port with SO_REUSEPORT, letting the kernel balance connections between
+them, or accept from a listening socket created by the supervisor before
+forking. Workers report their stats to the supervisor over a queue and dead
+workers are restarted.
+'''
+import logging
+import multiprocessing
+import os
+import Queue
+import threading
+import time
+from server import Server, bind_socket
+
+
+logger = logging.getLogger()
+
+
+def _report_stats(server, queue, interval):
+    pid = os.getpid()
+    while True:
+        time.sleep(interval)
+        queue.put((pid, server.get_stats()))
+
+
+def _worker_main(server_factory, addr, port, sock, stats_queue, stats_interval):
+    server = server_factory()
+    if sock is None:
+        sock = server.listen(addr, port, reuse_port=True)
+    reporter = threading.Thread(
+        target=_report_stats, args=(server, stats_queue, stats_interval)
+    )
+    reporter.daemon = True
+    reporter.start()
+    server.serve(sock)
+
+
+class Supervisor(object):
+    '''
+    Fork workers processes running servers created by server_factory.
+
+    server_factory  Callable returning a Server, called in each worker
+    workers         Number of worker processes, one per cpu by default
+    reuse_port      Bind a socket per worker with SO_REUSEPORT, otherwise the
+                    workers share a socket inherited from the supervisor
+    restart_delay   Minimum number of seconds between two starts of the same
+                    worker slot, keeps a crashing worker from spinning
+    listen_queue    Backlog of the shared listening socket
+
+    With reuse_port and port 0 the supervisor binds a socket to pick the port
+    and holds on to it, without listening, until it stops. port is the port
+    the workers listen on once started.
+    '''
+
+    def __init__(self, server_factory=Server, workers=None, reuse_port=True,
+                 stats_interval=1.0, restart_delay=1.0, listen_queue=64):
+        self.server_factory = server_factory
+        self.workers = workers or multiprocessing.cpu_count()
+        self.reuse_port = reuse_port
+        self.stats_interval = stats_interval
+        self.restart_delay = restart_delay
+        self.listen_queue = listen_queue
+        self.sock = None
+        self._reserved = None
+        self.processes = {}
+        self._started = {}
+        self._pids = set()
+        self._stats = {}
+        self._retired = {}
+        self._stats_queue = multiprocessing.Queue()
+        self._running = False
+
+    def run(self, addr, port):
+        '''
+        Start the workers and supervise them until stop is called.
+        '''
+        self.start(addr, port)
+        try:
+            while self._running:
+                self.supervise()
+        finally:
+            self.stop()
+
+    def start(self, addr, port):
+        self.addr = addr
+        self.port = port
+        if not self.reuse_port:
+            self.sock = bind_socket(addr, port)
+            self.sock.listen(self.listen_queue)
+            self.port = self.sock.getsockname()[1]
+        elif port == 0:
+            self._reserved = bind_socket(addr, port, reuse_port=True)
+            self.port = self._reserved.getsockname()[1]
+        self._running = True
+        for slot in range(self.workers):
+            self._start_worker(slot)
+
+    def _start_worker(self, slot):
+        process = multiprocessing.Process(
+            target=_worker_main,
+            args=(
+                self.server_factory, self.addr, self.port, self.sock,
+                self._stats_queue, self.stats_interval
+            )
+        )
+        process.daemon = True
+        process.start()
+        logger.info("Started worker %s pid %s", slot, process.pid)
+        self.processes[slot] = process
+        self._pids.add(process.pid)
+        self._started[slot] = time.time()
+
+    def supervise(self, timeout=None):
+        '''
+        Collect stats for up to one stats interval, then restart any dead
+        workers.
+        '''
+        if timeout is None:
+            timeout = self.stats_interval
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                pid, stats = self._stats_queue.get(timeout=remaining)
+            except Queue.Empty:
+                break
+            if pid in self._pids:
+                self._stats[pid] = stats
+        for slot, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if process.pid in self._pids:
+                logger.warning(
+                    "Worker %s pid %s exited with %s", slot, process.pid,
+                    process.exitcode
+                )
+                self._retire(process.pid)
+            if time.time() - self._started[slot] < self.restart_delay:
+                continue
+            self._start_worker(slot)
+
+    def _retire(self, pid):
+        self._pids.discard(pid)
+        stats = self._stats.pop(pid, {})
+        for name in stats:
+            self._retired[name] = self._retired.get(name, 0) + stats[name]
+
+    def stats(self):
+        '''
+        Counters summed over all current and past workers, as of their last
+        report.
+        '''
+        totals = dict(self._retired)
+        for stats in self._stats.values():
+            for name in stats:
+                totals[name] = totals.get(name, 0) + stats[name]
+        return totals
+
+    def stop(self):
+        self._running = False
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join()
+        for sock in (self.sock, self._reserved):
+            if sock is not None:
+                sock.close()
+        self.sock = self._reserved = None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s')
+    supervisor = Supervisor()
+    supervisor.run('0.0.0.0', 7431)
@@ -0,0 +1,148 @@
+import hashlib
+import multiprocessing
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache, SingleFlight, SharedCache, MISSING
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.get_stats() == {
+        'hits': 3, 'misses': 1, 'evictions': 1, 'expirations': 0
+    }
+
+
+def test_ttl():
+    clock = Clock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.put('a', None)
+    clock.now = 9
+    assert cache.get('a') is None
+    clock.now = 10
+    assert cache.get('a') is MISSING
+    assert len(cache) == 0
+    assert cache.get_stats()['expirations'] == 1
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'value'
+
+    leader = ThreadPoolExecutor(max_workers=1).submit(flight.do, 'key', fetch)
+    started.wait()
+    executor = ThreadPoolExecutor(max_workers=8)
+    followers = [executor.submit(flight.do, 'key', fetch) for _ in range(8)]
+    while flight.get_stats()['shared'] < 8:
+        time.sleep(0.001)
+    release.set()
+    assert leader.result() == 'value'
+    assert [f.result() for f in followers] == ['value'] * 8
+    assert calls == [1]
+    assert flight.get_stats() == {'calls': 1, 'shared': 8}
+
+
+def test_single_flight_shares_exceptions():
+    flight = SingleFlight()
+    with pytest.raises(KeyError):
+        flight.do('key', {}.__getitem__, 'missing')
+    assert flight.do('key', lambda: 1) == 1
+
+
+def test_max_bytes():
+    cache = LRUCache(max_bytes=10)
+    cache.put('a', 'a', 4)
+    cache.put('b', 'b', 4)
+    cache.put('c', 'c', 4)
+    assert cache.get('a') is MISSING
+    assert cache.size == 8
+    cache.invalidate('b')
+    assert cache.size == 4
+
+
+def _child_put(cache):
+    cache.put('from-child', 'child value')
+
+
+def test_shared_cache_across_processes():
+    cache = SharedCache(slots=16, slot_size=256)
+    process = multiprocessing.Process(target=_child_put, args=(cache,))
+    process.start()
+    process.join()
+    assert cache.get('from-child') == 'child value'
+    cache.put('list', ['ab', 'cd'])
+    assert cache.get('list') == 'abcd'
+    cache.invalidate('list')
+    assert cache.get('list') is MISSING
+    cache.put('big', 'x' * 256)
+    assert cache.get('big') is MISSING
+
+
+def test_shared_cache_clock_eviction(tmpdir):
+    clock = Clock()
+    cache = SharedCache(
+        slots=4, slot_size=64, ways=4, ttl=10, path=str(tmpdir.join('cache')),
+        clock=clock
+    )
+    for key in 'abcd':
+        cache.put(key, key)
+    assert cache.get('a') == 'a'
+    cache.put('e', 'e')
+    assert cache.get('a') == 'a'
+    assert cache.get('e') == 'e'
+    assert sum(cache.get(key) is MISSING for key in 'bcd') == 1
+    clock.now = 10
+    assert cache.get('a') is MISSING
+    cache.close()
+
+
+def test_shared_cache_clock_hand():
+    cache = SharedCache(slots=8, slot_size=64, ways=4)
+    # Keys of one set, none are read so every eviction takes the slot under
+    # the hand and moves it on.
+    keys = [
+        key for key in map(str, range(1000))
+        if next(cache._ways(hashlib.sha1(key).digest())) == 0
+    ][:8]
+    for key in keys:
+        cache.put(key, key)
+    assert [cache.get(key) for key in keys] == [MISSING] * 4 + keys[4:]
+    assert cache.get_stats()['evictions'] == 4
+
+
+def test_shared_cache_file_lock_excludes_threads(tmpdir):
+    cache = SharedCache(slots=4, slot_size=64, path=str(tmpdir.join('cache')))
+    cache._lock()
+    thread = threading.Thread(target=cache.put, args=('a', 'a'))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+    cache._unlock()
+    thread.join()
+    assert cache.get('a') == 'a'
+    cache.close()
@@ -0,0 +1,111 @@
+from msnrtp import RemotingMethod, OP_REQUEST
+from msnrbf.enum import binary_type as bt
+from msnrbf.enum.message_enum import MessageEnum
+from msnrbf.records import (
+    SerializationHeader, BinaryMethodCall, ArraySingleObject, MemberReference,
+    BinaryObjectString, MessageEnd
+)
+from msnrbf.structures import ArrayInfo
+from decode import decode_message, decode_many, project_message
+from server import encode_method_return, encode_exception
+from system_classes import (
+    CompareInfo, CaseInsensativeComparer, RemotingException
+)
+
+
+URI = 'tcp://localhost:7431/Security.rem'
+TYPE_NAME = 'Security.ISecurityQuery, Security.Client'
+
+
+def _request(*args):
+    method = RemotingMethod(
+        URI, TYPE_NAME, 'Lookup', [(bt.STRING, None)] * len(args), None
+    )
+    return method.create_request(list(args)).pack()
+
+
+def test_decode_message_frame():
+    msg = decode_message(_request('alice', 'bob'))
+    assert msg.operation_type == OP_REQUEST
+    assert msg.uri == URI
+    assert msg.type_name == TYPE_NAME
+    assert msg.method_name == 'Lookup'
+    assert msg.args == ['alice', 'bob']
+    assert msg.return_value is None
+    assert msg.exception is None
+
+
+def _call_array_body(message_enum, *records):
+    return b''.join(
+        [
+            SerializationHeader(1, -1).pack(),
+            BinaryMethodCall(message_enum, 'Lookup', TYPE_NAME).pack(),
+        ] + [record.pack() for record in records] + [MessageEnd().pack()]
+    )
+
+
+def test_decode_args_is_array():
+    body = _call_array_body(
+        MessageEnum(NoContext=True, ArgsIsArray=True),
+        ArraySingleObject(ArrayInfo(1, 2)),
+        BinaryObjectString(2, 'alice'),
+        BinaryObjectString(3, 'bob'),
+    )
+    assert decode_message(body).args == ['alice', 'bob']
+
+
+def test_decode_args_in_array():
+    body = _call_array_body(
+        MessageEnum(NoContext=True, ArgsInArray=True),
+        ArraySingleObject(ArrayInfo(1, 1)),
+        MemberReference(2),
+        ArraySingleObject(ArrayInfo(2, 2)),
+        BinaryObjectString(3, 'alice'),
+        BinaryObjectString(4, 'bob'),
+    )
+    assert decode_message(body).args == ['alice', 'bob']
+
+
+def test_decode_many_ordered():
+    names = ['user{}'.format(n) for n in range(50)]
+    messages = [_request(name) for name in names]
+    results = list(decode_many(messages, workers=2, chunksize=8))
+    assert [r.args[0] for r in results] == names
+
+
+def test_decode_many_unordered():
+    names = ['user{}'.format(n) for n in range(50)]
+    messages = [_request(name) for name in names]
+    results = list(decode_many(messages, workers=2, ordered=False, chunksize=8))
+    assert sorted(r.args[0] for r in results) == sorted(names)
+
+
+def test_decode_many_inline():
+    results = list(decode_many([_request('alice')], workers=0))
+    assert results[0].args == ['alice']
+
+
+def test_project_message():
+    comparer = CaseInsensativeComparer()
+    comparer.m_compareInfo = CompareInfo()
+    comparer.m_compareInfo.win32LCID = 1033
+    comparer.m_compareInfo.culture = 7
+    data = b''.join(encode_method_return(comparer))
+    culture = ('CaseInsensitiveComparer', 'm_compareInfo', 'culture')
+    info = ('System.Collections.CaseInsensitiveComparer', 'm_compareInfo')
+    missing = ('CompareInfo', 'missing')
+    result = project_message(data, [culture, info, missing])
+    assert result[culture] == [7]
+    assert result[missing] == []
+    assert result[info][0].object_id > 0
+    assert project_message(data, [('CompareInfo', 'win32LCID')]) == {
+        ('CompareInfo', 'win32LCID'): [1033]
+    }
+
+
+def test_project_message_strings():
+    exception = RemotingException()
+    exception.message = 'Server is busy'
+    data = encode_exception(exception)
+    path = ('RemotingException', 'Message')
+    assert project_message(data, [path])[path] == ['Server is busy']
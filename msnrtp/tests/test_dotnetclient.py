@@ -0,0 +1,220 @@
+import socket
+import threading
+import time
+import pytest
+from msnrtp import RemotingMethod, OP_ONEWAYREQUEST
+from msnrbf.enum import binary_type as bt
+from msnrbf.enum import primitive_type as pt
+from decode import decode_message
+from netio import RecvBuffer
+from cache import LRUCache
+from server import Server, Handler, THREAD
+from test_server import _compare_info
+from dotnetclient import BasicClient, ClientPool, TimeoutException, gather_calls
+
+
+def test_call_deadline():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = BasicClient(*listener.getsockname(), timeout=0.1)
+    start = time.time()
+    try:
+        with pytest.raises(TimeoutException):
+            client.call('\x00' * 16)
+    finally:
+        client.sock.close()
+        listener.close()
+    assert time.time() - start < 1
+
+
+def test_send_batch():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    method = RemotingMethod(
+        'tcp://localhost/Events.rem', 'Events.IEvents, Events', 'Notify',
+        [(bt.STRING, None), (bt.PRIMITIVE, pt.INT32)], None,
+        operation_type=OP_ONEWAYREQUEST
+    )
+    arglists = [('event', n) for n in range(1000)]
+    pool = ClientPool(*listener.getsockname(), timeout=5)
+    try:
+        sent = pool.send_batch(method, arglists)
+        conn, addr = listener.accept()
+        buf = RecvBuffer()
+        for args in arglists:
+            frame, view = buf.recv_frame(conn)
+            assert frame.operation_type == OP_ONEWAYREQUEST
+            assert decode_message(view.tobytes()).args == list(args)
+        assert sent == len(method.pack_request(arglists[0])) * len(arglists)
+        conn.close()
+    finally:
+        pool.close()
+        listener.close()
+
+
+def _serve(server):
+    sock = server.listen('127.0.0.1', 0)
+    thread = threading.Thread(target=server.serve, args=(sock,))
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()
+
+
+def test_cached_call():
+    calls = []
+
+    def GetCompareInfo(name):
+        calls.append(name)
+        return _compare_info(len(name))
+
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo))
+    host, port = _serve(server)
+    method = RemotingMethod(
+        'tcp://{}:{}/Globalization.rem'.format(host, port),
+        'Globalization.ICultureQuery, Globalization.Client', 'GetCompareInfo',
+        [(bt.STRING, None)], None, cache=LRUCache(ttl=60)
+    )
+    pool = ClientPool(host, port, timeout=5)
+    try:
+        for name in ('en-US', 'en-US', 'fr-FR', 'en-US'):
+            reply = pool.call(method, [name])
+            assert reply.return_value.members['culture'] == len(name)
+    finally:
+        pool.close()
+    assert calls == ['en-US', 'fr-FR']
+    assert method.cache.get_stats()['hits'] == 2
+
+
+def test_hedged_call():
+    stall = threading.Event()
+    calls = []
+
+    def GetCompareInfo(name):
+        calls.append(name)
+        if len(calls) == 1:
+            stall.wait()
+        return _compare_info(len(name))
+
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo, execution=THREAD))
+    host, port = _serve(server)
+    method = RemotingMethod(
+        'tcp://{}:{}/Globalization.rem'.format(host, port),
+        'Globalization.ICultureQuery, Globalization.Client', 'GetCompareInfo',
+        [(bt.STRING, None)], None, idempotent=True
+    )
+    pool = ClientPool(host, port, timeout=5, hedge_delay=0.05)
+    try:
+        start = time.time()
+        reply = pool.call(method, ['en-US'])
+        assert time.time() - start < 1
+        assert reply.return_value.members['culture'] == 5
+    finally:
+        stall.set()
+        pool.close()
+    assert len(calls) == 2
+    assert pool.get_stats() == {'hedges': 1, 'hedges_won': 1, 'hedges_skipped': 0}
+    assert len(pool.latencies) == 1
+
+
+def test_hedge_skipped_without_free_connection():
+    def GetCompareInfo(name):
+        time.sleep(0.3)
+        return _compare_info(len(name))
+
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo, execution=THREAD))
+    host, port = _serve(server)
+    method = RemotingMethod(
+        'tcp://{}:{}/Globalization.rem'.format(host, port),
+        'Globalization.ICultureQuery, Globalization.Client', 'GetCompareInfo',
+        [(bt.STRING, None)], None, idempotent=True
+    )
+    pool = ClientPool(host, port, max_connections=1, timeout=5, hedge_delay=0.05)
+    try:
+        start = time.time()
+        reply = pool.call(method, ['en-US'])
+        assert time.time() - start < 1
+        assert reply.return_value.members['culture'] == 5
+    finally:
+        pool.close()
+    assert pool.get_stats() == {'hedges': 0, 'hedges_won': 0, 'hedges_skipped': 1}
+
+
+class FanOutServer(Server):
+    _max_workers = 8
+    _listen_queue = 16
+
+
+def test_gather_calls():
+    server = FanOutServer()
+    server.add_handler(
+        Handler(lambda name: _compare_info(len(name)), method_name='GetCompareInfo')
+    )
+    host, port = _serve(server)
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.1', 0))
+    dead_port = closed.getsockname()[1]
+    closed.close()
+    method = RemotingMethod(
+        'tcp://localhost/Globalization.rem',
+        'Globalization.ICultureQuery, Globalization.Client', 'GetCompareInfo',
+        [(bt.STRING, None)], None
+    )
+    uris = ['tcp://{}:{}/Globalization.rem'.format(host, port)] * 10
+    uris.insert(3, 'tcp://127.0.0.1:{}/Globalization.rem'.format(dead_port))
+    results = gather_calls(method, uris, ['en-US'], concurrency=4, timeout=5)
+    assert isinstance(results.pop(3), socket.error)
+    assert [r.return_value.members['culture'] for r in results] == [5] * 10
+
+
+@pytest.mark.parametrize('idempotent', [False, True])
+def test_request_retry(idempotent):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    received = []
+
+    def serve():
+        # Reply to the first request, then drop the connection after reading
+        # the second one. A new connection gets its request answered.
+        for replies in (1, 2)[:2 if idempotent else 1]:
+            conn, addr = listener.accept()
+            buf = RecvBuffer()
+            for n in range(2):
+                frame, view = buf.recv_frame(conn)
+                if frame is None:
+                    break
+                received.append(view.tobytes())
+                if n < replies:
+                    conn.sendall(view.tobytes())
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    method = RemotingMethod(
+        'tcp://localhost/Globalization.rem',
+        'Globalization.ICultureQuery, Globalization.Client', 'GetCompareInfo',
+        [(bt.STRING, None)], None
+    )
+    data = method.pack_request(['en-US'])
+    pool = ClientPool(*listener.getsockname(), timeout=5)
+    try:
+        assert pool.request(data, idempotent) == data
+        # The server drops the connection after reading the request, it may
+        # have run it.
+        if idempotent:
+            assert pool.request(data, idempotent) == data
+            assert len(received) == 3
+        else:
+            with pytest.raises(socket.error):
+                pool.request(data, idempotent)
+            assert len(received) == 2
+    finally:
+        pool.close()
+        thread.join(5)
+        listener.close()
@@ -0,0 +1,224 @@
+import datetime
+import struct
+import pytest
+from msnrtp import (
+    RemotingMethod, SingleMessage, RequestUriHeader, CountedString, OP_REQUEST,
+    OP_ONEWAYREQUEST,
+    ReplyTemplate, peek_frame, peek_call
+)
+from msnrbf.enum import binary_type as bt
+from msnrbf.enum import primitive_type as pt
+from msnrbf.types import LengthPrefixedString, Datetime, unpack_length_from
+from decode import decode_message
+from system_classes import CompareInfo, CaseInsensativeComparer
+
+
+URI = 'tcp://localhost:7431/Security.rem'
+TYPE_NAME = 'Security.ISecurityQuery, Security.Client'
+
+
+class _UTC(datetime.tzinfo):
+
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+
+def _method():
+    return RemotingMethod(URI, TYPE_NAME, 'Lookup', [(bt.STRING, None)], None)
+
+
+def test_unpack_length_from():
+    for length in (0, 4, 127, 128, 134, 256, 16384, 2 ** 21):
+        lps = LengthPrefixedString('a' * length)
+        byts = 'xx' + lps.pack()
+        assert unpack_length_from(byts, 2) == (length, len(byts) - length)
+
+
+def test_peek_frame():
+    data = _method().create_request(['alice']).pack()
+    frame = peek_frame(data)
+    assert frame.operation_type == OP_REQUEST
+    assert frame.uri == URI
+    assert frame.content_type == 'application/octet-stream'
+    assert frame.frame_length == len(data)
+    assert data[frame.body_offset:] == SingleMessage.unpack(data).message
+    assert peek_frame(data[:frame.body_offset - 1]) is None
+
+
+def test_peek_frame_string_encoding():
+    data = _method().create_request(['alice']).pack()
+    uri = CountedString(1, URI).pack()
+    assert uri in data
+    utf16 = URI.encode('utf-16-le')
+    frame = peek_frame(data.replace(
+        uri, struct.pack('<Bi', 0, len(utf16)) + utf16))
+    assert frame.uri == URI
+    with pytest.raises(Exception) as excinfo:
+        peek_frame(data.replace(uri, '\x02' + uri[1:]))
+    assert 'Unsupported string encoding' in str(excinfo.value)
+
+
+def test_peek_frame_negative_length():
+    data = _method().create_request(['alice']).pack()
+    frame = peek_frame(data)
+    # The content length follows the protocol id, version and operation type
+    data = data[:10] + struct.pack('<i', -frame.body_offset) + data[14:]
+    with pytest.raises(Exception) as excinfo:
+        peek_frame(data)
+    assert 'Invalid content length' in str(excinfo.value)
+
+
+def test_peek_frame_memoryview():
+    data = bytearray(_method().create_request(['alice']).pack())
+    frame = peek_frame(memoryview(data))
+    assert frame.uri == URI
+    assert frame.frame_length == len(data)
+
+
+def test_peek_call():
+    data = _method().create_request(['alice']).pack()
+    call = peek_call(data)
+    assert call.uri == URI
+    assert call.type_name == TYPE_NAME
+    assert call.method_name == 'Lookup'
+    assert call.message_enum.ArgsInline
+
+
+def test_peek_call_not_a_call():
+    msg = SingleMessage(OP_REQUEST, '\x0b', headers=[RequestUriHeader(URI)])
+    assert peek_call(msg.pack()) is None
+
+
+def test_pack_request_matches_create_request():
+    method = RemotingMethod(
+        URI, TYPE_NAME, 'Lookup', [(bt.STRING, None)] * 2, None,
+        operation_type=OP_ONEWAYREQUEST
+    )
+    args = ['alice', u'\xe9' * 200]
+    data = method.pack_request(args)
+    assert data == method.create_request(args).pack()
+    assert peek_frame(data).operation_type == OP_ONEWAYREQUEST
+    assert decode_message(data).args == args
+
+
+def test_pack_request_no_args():
+    data = RemotingMethod(URI, TYPE_NAME, 'Ping', [], None).pack_request([])
+    call = peek_call(data)
+    assert call.method_name == 'Ping'
+    assert call.message_enum.NoArgs
+    assert decode_message(data).args == []
+
+
+def test_pack_request_primitive_args():
+    spec = [
+        (bt.PRIMITIVE, pt.INT32), (bt.PRIMITIVE, pt.DOUBLE),
+        (bt.PRIMITIVE, pt.BOOLEAN), (bt.PRIMITIVE, pt.INT64),
+        (bt.PRIMITIVE, pt.UINT16), (bt.PRIMITIVE, pt.CHAR),
+        (bt.PRIMITIVE, pt.DECIMAL), (bt.STRING, None), (bt.STRING, None),
+        (bt.PRIMITIVE, pt.DATETIME),
+    ]
+    method = RemotingMethod(URI, TYPE_NAME, 'Update', spec, None)
+    when = datetime.datetime(2016, 3, 1, 12, 30, 15, 250000)
+    args = [-5, 2.5, 1, 2 ** 40, 7, u'\xe9', u'1.25', u'h\xe9', None, when]
+    data = method.pack_request(args)
+    assert peek_call(data).message_enum.ArgsInline
+    assert data == method.create_request(args).pack()
+    decoded = decode_message(data).args
+    assert decoded[:-1] == args[:-1]
+    assert decoded[-1] == Datetime(635924322152500000)
+    assert decoded[-1].value == when
+    # DateTime ValueWithCode, little endian ticks
+    assert data.endswith('\x0d' + struct.pack('<q', 635924322152500000) + '\x0b')
+
+
+def test_datetime_kind():
+    when = datetime.datetime(2016, 3, 1, 12, 30, 15, 250000)
+    utc = Datetime.from_datetime(when.replace(tzinfo=_UTC()))
+    assert utc.pack() == struct.pack('<q', 635924322152500000 | 1 << 62)
+    assert Datetime.unpack(utc.pack()) == utc
+
+
+def test_pack_request_call_array():
+    spec = [
+        (bt.SYSTEM_CLASS, None), (bt.PRIMITIVE, pt.INT32), (bt.STRING, None),
+        (bt.STRING, None),
+    ]
+    method = RemotingMethod(URI, TYPE_NAME, 'Compare', spec, None)
+    info = CompareInfo()
+    info.win32LCID = 1033
+    info.culture = 3
+    data = method.pack_request([info, 9, u'h\xe9', None])
+    assert peek_call(data).message_enum.ArgsIsArray
+    args = decode_message(data).args
+    assert args[0].members['culture'] == 3
+    assert args[1:] == [9, u'h\xe9', None]
+    # MS-NRBF 2.2.3.1 and 2.7, each argument is an item of the call array
+    expected = b''.join([
+        # SerializationHeader, root id 1 (the call array), header id -1
+        '\x00\x01\x00\x00\x00\xff\xff\xff\xff\x01\x00\x00\x00\x00\x00\x00\x00',
+        # BinaryMethodCall, NoContext | ArgsIsArray
+        '\x15\x14\x00\x00\x00',
+        '\x12\x07Compare',
+        '\x12\x28Security.ISecurityQuery, Security.Client',
+        # ArraySingleObject, object id 1, 4 items
+        '\x10\x01\x00\x00\x00\x04\x00\x00\x00',
+        # MemberReference to object 2
+        '\x09\x02\x00\x00\x00',
+        # MemberPrimitiveTyped Int32 9
+        '\x08\x08\x09\x00\x00\x00',
+        # BinaryObjectString, object id 3
+        '\x06\x03\x00\x00\x00\x03h\xc3\xa9',
+        # ObjectNull
+        '\x0a',
+        # SystemClassWithMembersAndTypes, object id 2, two Int32 members
+        '\x04\x02\x00\x00\x00\x20System.Globalization.CompareInfo',
+        '\x02\x00\x00\x00\x09win32LCID\x07culture\x00\x00\x08\x08',
+        '\x09\x04\x00\x00\x03\x00\x00\x00',
+        # MessageEnd
+        '\x0b',
+    ])
+    assert data[peek_frame(data).body_offset:] == expected
+
+
+def _comparer(culture):
+    comparer = CaseInsensativeComparer()
+    comparer.m_compareInfo = CompareInfo()
+    comparer.m_compareInfo.win32LCID = 1033
+    comparer.m_compareInfo.culture = culture
+    return comparer
+
+
+def test_reply_template():
+    template = ReplyTemplate(_comparer(1), ['m_compareInfo.culture'])
+    data = template.pack([42])
+    expected = _comparer(42)
+    assert bytes(data) == bytes(ReplyTemplate(expected, []).pack([]))
+    info = decode_message(bytes(data)).return_value.members['m_compareInfo']
+    assert info.members['culture'] == 42
+    assert info.members['win32LCID'] == 1033
+
+
+def test_pack_request_array_args():
+    spec = [
+        (bt.STRING_ARRAY, None), (bt.PRIMITIVE_ARRAY, pt.INT32),
+        (bt.OBJECT_ARRAY, None),
+    ]
+    method = RemotingMethod(URI, TYPE_NAME, 'Lookup', spec, None)
+    data = method.pack_request([['a', None], [1, 2], ['b']])
+    assert decode_message(data).args == [['a', None], [1, 2], ['b']]
+    body = data[peek_frame(data).body_offset:]
+    # Call array items reference the arrays, which follow the call array
+    assert body.endswith(b''.join([
+        '\x10\x01\x00\x00\x00\x03\x00\x00\x00',
+        '\x09\x02\x00\x00\x00\x09\x04\x00\x00\x00\x09\x05\x00\x00\x00',
+        # ArraySingleString, object id 2, 'a' and null
+        '\x11\x02\x00\x00\x00\x02\x00\x00\x00',
+        '\x06\x03\x00\x00\x00\x01a\x0a',
+        # ArraySinglePrimitive, object id 4, Int32 1 and 2
+        '\x0f\x04\x00\x00\x00\x02\x00\x00\x00\x08',
+        '\x01\x00\x00\x00\x02\x00\x00\x00',
+        # ArraySingleObject, object id 5, 'b'
+        '\x10\x05\x00\x00\x00\x01\x00\x00\x00',
+        '\x06\x06\x00\x00\x00\x01b',
+        '\x0b',
+    ]))
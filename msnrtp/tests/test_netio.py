@@ -0,0 +1,44 @@
+import socket
+import threading
+from msnrtp import FrameTemplate, RequestUriHeader, SingleMessage, OP_REQUEST
+from netio import RecvBuffer, sendall_buffers
+
+
+def _frame(body):
+    return FrameTemplate(OP_REQUEST, [RequestUriHeader('/Service.rem' * 20)]).pack(body)
+
+
+def test_recv_buffer_pipelined_frames():
+    frames = [_frame('a' * n) for n in (10, 3000, 100000, 5)]
+    sock, peer = socket.socketpair()
+    buf = RecvBuffer(1024)
+    try:
+        peer.sendall(''.join(frames[:2]))
+        for expected in frames[:2]:
+            frame, view = buf.recv_frame(sock)
+            assert view.tobytes() == expected
+            assert frame.frame_length == len(expected)
+        for expected in frames[2:]:
+            peer.sendall(expected)
+            frame, view = buf.recv_frame(sock)
+            assert view.tobytes() == expected
+        peer.close()
+        assert buf.recv_frame(sock) == (None, None)
+    finally:
+        sock.close()
+
+
+def test_send_message_buffers():
+    frame = _frame('b' * 200000)
+    msg = SingleMessage.unpack(frame)
+    assert ''.join(msg.buffers()) == msg.pack() == frame
+    sock, peer = socket.socketpair()
+    try:
+        thread = threading.Thread(target=sendall_buffers, args=(sock, msg.buffers()))
+        thread.start()
+        frame_info, view = RecvBuffer().recv_frame(peer)
+        thread.join()
+        assert view.tobytes() == frame
+    finally:
+        sock.close()
+        peer.close()
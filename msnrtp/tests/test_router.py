@@ -0,0 +1,161 @@
+import socket
+import threading
+import pytest
+from msnrtp import RemotingMethod, peek_frame
+from msnrbf.enum import binary_type as bt
+from decode import decode_message
+from server import Server, Handler
+from router import Router, Backend, BackendConnection, NoRoute, BackendBusy
+from dotnetclient import ClientPool
+from test_server import _compare_info
+from test_dotnetclient import _serve
+
+
+TYPE_NAME = 'Globalization.ICultureQuery, Globalization.Client'
+
+
+def _method(uri, method_name='GetCompareInfo'):
+    return RemotingMethod(uri, TYPE_NAME, method_name, [(bt.STRING, None)], None)
+
+
+def _frame(uri, method_name='GetCompareInfo'):
+    data = _method(uri, method_name).pack_request(['en-US'])
+    return peek_frame(data), data
+
+
+def test_route_precedence():
+    backends = dict((name, Backend('127.0.0.1', 0)) for name in 'abc')
+    router = Router(
+        backends, uri_routes={'/Globalization.rem': 'a'},
+        method_routes={'GetCulture': 'b'}, default='c'
+    )
+    assert router.route(*_frame('tcp://host:1/Globalization.rem')) is backends['a']
+    assert router.route(
+        *_frame('tcp://host:1/Globalization.rem', 'GetCulture')
+    ) is backends['b']
+    assert router.route(*_frame('tcp://host:1/Other.rem')) is backends['c']
+    router.default = None
+    with pytest.raises(NoRoute):
+        router.route(*_frame('tcp://host:1/Other.rem'))
+
+
+def test_backend_replaces_closed_connections():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    backend = Backend(*listener.getsockname(), max_connections=1,
+                      acquire_timeout=0.05)
+    try:
+        with backend.connection() as first:
+            conn, addr = listener.accept()
+            with pytest.raises(BackendBusy):
+                with backend.connection():
+                    pass
+        conn.close()
+        with backend.connection() as second:
+            assert second is not first
+            listener.accept()[0].close()
+    finally:
+        backend.close()
+        listener.close()
+
+
+def test_relay_to_closing_backend():
+    names = []
+
+    def GetCompareInfo(name):
+        names.append(name)
+        return _compare_info(len(name))
+
+    # The server closes each connection after replying, a request may be
+    # sent before the close is seen.
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo))
+    backend = Backend(*_serve(server), timeout=5, idempotent=True)
+    router = Router({'globalization': backend}, default='globalization')
+    host, port = _serve(router)
+    method = _method('tcp://{}:{}/Globalization.rem'.format(host, port))
+    pool = ClientPool(host, port, timeout=5)
+    try:
+        for name in ('en-US', 'fr-FR', 'de', 'en-GB'):
+            reply = pool.call(method, [name])
+            assert reply.exception is None
+            assert reply.return_value.members['culture'] == len(name)
+    finally:
+        pool.close()
+        backend.close()
+    assert names == ['en-US', 'fr-FR', 'de', 'en-GB']
+
+
+def test_backend_retries_on_new_connection():
+    names = []
+
+    def GetCompareInfo(name):
+        names.append(name)
+        return _compare_info(len(name))
+
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo))
+    backend = Backend(*_serve(server), timeout=5)
+    frame, data = _frame('tcp://host:1/Globalization.rem')
+    # An idle connection failing before any of the request is sent, the
+    # request goes out on a new connection.
+    stale, peer = socket.socketpair()
+    stale.shutdown(socket.SHUT_WR)
+    backend._idle.append(BackendConnection(stale))
+    try:
+        with backend.exchange([data]) as (reply_frame, reply):
+            assert reply_frame.frame_length == len(reply)
+            reply = decode_message(reply.tobytes())
+        assert reply.return_value.members['culture'] == 5
+        assert names == ['en-US']
+    finally:
+        peer.close()
+
+    # An idle connection closed once the request arrived, the backend may
+    # have run it so it is not sent again.
+    stale, peer = socket.socketpair()
+    backend._idle.append(BackendConnection(stale))
+
+    def drop():
+        peer.recv(65536)
+        peer.close()
+
+    thread = threading.Thread(target=drop)
+    thread.start()
+    try:
+        with pytest.raises(socket.error):
+            with backend.exchange([data]):
+                pass
+        assert names == ['en-US']
+    finally:
+        thread.join()
+        backend.close()
+
+
+class OneWorkerRouter(Router):
+    _max_workers = 1
+
+
+def test_idle_clients_do_not_hold_workers():
+    def GetCompareInfo(name):
+        return _compare_info(len(name))
+
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo))
+    backend = Backend(*_serve(server), timeout=5, idempotent=True)
+    router = OneWorkerRouter({'globalization': backend}, default='globalization')
+    host, port = _serve(router)
+    method = _method('tcp://{}:{}/Globalization.rem'.format(host, port))
+    # Each pool keeps its connection open between calls
+    pools = [ClientPool(host, port, timeout=5) for _ in range(2)]
+    try:
+        for name in ('en-US', 'fr-FR', 'de'):
+            for pool in pools:
+                reply = pool.call(method, [name])
+                assert reply.return_value.members['culture'] == len(name)
+        assert router.get_stats()['connections'] == 2
+    finally:
+        for pool in pools:
+            pool.close()
+        backend.close()
@@ -0,0 +1,65 @@
+import pytest
+from msnrbf.grammar import RemotingMessage, MemberPrimitiveUnTyped, StreamError
+from msnrbf.scanner import scan_records, MESSAGE_END
+from system_classes import (
+    CompareInfo, CaseInsensativeComparer, RemotingException
+)
+
+
+def _comparer():
+    comparer = CaseInsensativeComparer()
+    comparer.m_compareInfo = CompareInfo()
+    comparer.m_compareInfo.win32LCID = 1033
+    comparer.m_compareInfo.culture = 7
+    return comparer
+
+
+def _exception():
+    exception = RemotingException()
+    exception.message = 'Server is busy'
+    return exception
+
+
+def test_scan_records_matches_grammar():
+    for message in (
+            RemotingMessage.build_method_return(value=_comparer()),
+            RemotingMessage.build_method_return(exception=_exception())):
+        body = message.pack()
+        records = scan_records(body)
+        expected = [
+            record.enum for record in message.stream()
+            if not isinstance(record, MemberPrimitiveUnTyped)
+        ]
+        assert [record[0] for record in records] == expected
+        assert records[-1] == (MESSAGE_END, len(body) - 1, 1, 0)
+
+
+def test_scan_records_boundaries():
+    body = RemotingMessage.build_method_return(exception=_exception()).pack()
+    records = scan_records(body)
+    # The exception record holds its string members
+    exception = records[4]
+    assert exception[0] == 4 and exception[3] == 2
+    strings = [record for record in records if record[0] == 6]
+    assert strings
+    for record in strings:
+        assert exception[1] < record[1]
+        assert record[1] + record[2] <= exception[1] + exception[2]
+    values = [body[record[1] + 6:record[1] + record[2]] for record in strings]
+    assert 'Server is busy' in values
+    # Records not nested in another tile the message
+    offset = 0
+    for record in records:
+        if record[1] == offset:
+            offset += record[2]
+    assert offset == len(body)
+
+
+def test_scan_records_invalid():
+    body = RemotingMessage.build_method_return(exception=_exception()).pack()
+    with pytest.raises(StreamError):
+        scan_records(body[:-20])
+    with pytest.raises(StreamError):
+        scan_records(body[17:])
+    with pytest.raises(StreamError):
+        scan_records(body[:-1] + b'\x30')
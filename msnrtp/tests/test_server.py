@@ -0,0 +1,281 @@
+import socket
+import threading
+import time
+import pytest
+from msnrtp import RemotingMethod, peek_frame
+from msnrbf.enum import binary_type as bt
+from msnrbf.enum import primitive_type as pt
+from msnrbf.grammar import StreamError
+from decode import decode_message
+from concurrent.futures import ThreadPoolExecutor
+from server import (
+    Server, Handler, ArgsDecoder, decode_call_args, BoundedExecutor, PriorityExecutor, INLINE, THREAD, PROCESS
+)
+from system_classes import CompareInfo
+from cache import LRUCache, SharedCache
+
+
+URI = 'tcp://localhost:7431/Globalization.rem'
+TYPE_NAME = 'Globalization.ICultureQuery, Globalization.Client'
+
+
+def _request(method_name, *args):
+    method = RemotingMethod(
+        URI, TYPE_NAME, method_name, [(bt.STRING, None)] * len(args), None
+    )
+    return method.create_request(list(args)).pack()
+
+
+def _compare_info(culture):
+    info = CompareInfo()
+    info.win32LCID = 1033
+    info.culture = culture
+    return info
+
+
+def _reply(server, data):
+    sock, peer = socket.socketpair()
+    try:
+        server.handle_request(sock, data)
+        reply = peer.recv(65536)
+    finally:
+        sock.close()
+        peer.close()
+    assert peek_frame(reply).frame_length == len(reply)
+    return decode_message(reply)
+
+
+def test_register_and_dispatch():
+    server = Server()
+
+    @server.register('/Globalization.rem', 'Globalization.ICultureQuery')
+    def GetCompareInfo(name):
+        assert name == 'en-US'
+        return _compare_info(127)
+
+    reply = _reply(server, _request('GetCompareInfo', 'en-US'))
+    assert reply.exception is None
+    assert reply.return_value.class_name == 'System.Globalization.CompareInfo'
+    assert reply.return_value.members['culture'] == 127
+
+
+def test_args_decoder():
+    spec = [
+        (bt.PRIMITIVE, pt.INT32), (bt.STRING, None), (bt.STRING, None),
+        (bt.PRIMITIVE, pt.DOUBLE),
+    ]
+    method = RemotingMethod(URI, TYPE_NAME, 'Update', spec, None)
+    data = method.pack_request([7, u'h\xe9', None, 2.5])
+    decoder = ArgsDecoder(spec)
+    assert decoder(data) == decode_call_args(data) == [7, u'h\xe9', None, 2.5]
+    assert Handler(lambda: None).decode_args(data) == [7, u'h\xe9', None, 2.5]
+    with pytest.raises(StreamError):
+        ArgsDecoder(spec[:3])(data)
+    with pytest.raises(StreamError):
+        ArgsDecoder(list(reversed(spec)))(data)
+    # Arguments passed in a call array are decoded in full
+    spec = [(bt.STRING_ARRAY, None)]
+    method = RemotingMethod(URI, TYPE_NAME, 'Update', spec, None)
+    data = method.pack_request([[u'a', u'b']])
+    assert ArgsDecoder(spec)(data) == decode_call_args(data)
+
+
+def test_find_handler_specificity():
+    server = Server()
+    generic = server.add_handler(Handler(lambda: None, method_name='GetCulture'))
+    specific = server.add_handler(
+        Handler(lambda: None, URI, TYPE_NAME, 'GetCulture')
+    )
+    assert specific.key == ('/Globalization.rem', 'Globalization.ICultureQuery', 'GetCulture')
+
+    class Call(object):
+        uri = URI
+        type_name = TYPE_NAME
+        method_name = 'GetCulture'
+
+    assert server.find_handler(Call) is specific
+    Call.uri = '/Other.rem'
+    assert server.find_handler(Call) is generic
+    Call.method_name = 'Missing'
+    assert server.find_handler(Call) is None
+
+
+def test_missing_handler_replies_with_exception():
+    reply = _reply(Server(), _request('Missing'))
+    assert reply.exception.class_name == 'System.Runtime.Remoting.RemotingException'
+
+
+def GetCompareInfo(name):
+    return _compare_info(len(name))
+
+
+def test_execution_policies():
+    for execution in (INLINE, THREAD, PROCESS):
+        server = Server()
+        server.add_handler(Handler(GetCompareInfo, execution=execution))
+        reply = _reply(server, _request('GetCompareInfo', 'en-US'))
+        assert reply.return_value.members['culture'] == 5
+
+
+def test_process_handler_reply_cache():
+    for reply_cache in (LRUCache(ttl=60), SharedCache(slots=16)):
+        server = Server()
+        server.add_handler(
+            Handler(GetCompareInfo, execution=PROCESS, reply_cache=reply_cache)
+        )
+        for name in ('en-US', 'en-US', 'fr'):
+            reply = _reply(server, _request('GetCompareInfo', name))
+            assert reply.return_value.members['culture'] == len(name)
+        assert server.get_stats()['cached'] == 1
+
+
+def test_process_handler_must_pickle():
+    server = Server()
+    with pytest.raises(Exception):
+        server.add_handler(Handler(lambda: None, method_name='f', execution=PROCESS))
+
+
+def test_bounded_executor_refuses_when_full():
+    release = threading.Event()
+    executor = BoundedExecutor(ThreadPoolExecutor(max_workers=1), max_pending=2)
+    futures = [executor.try_submit(release.wait) for _ in range(2)]
+    assert executor.try_submit(release.wait) is None
+    release.set()
+    for future in futures:
+        future.result()
+    assert executor.try_submit(release.wait).result()
+
+
+def test_shed_sends_busy_reply():
+    sock, peer = socket.socketpair()
+    peer.sendall(_request('GetCompareInfo', 'en-US'))
+    Server().shed(sock, None)
+    reply = decode_message(peer.recv(65536))
+    peer.close()
+    assert reply.exception.members['Message'] == 'Server is busy'
+
+
+def test_saturated_pool_does_not_block_other_requests():
+    release = threading.Event()
+    server = Server()
+    server.add_pool('reports', max_workers=1, max_pending=1)
+    server.add_handler(
+        Handler(lambda name: release.wait(), method_name='GetReport', pool='reports')
+    )
+    server.add_handler(Handler(GetCompareInfo))
+
+    slow, slow_peer = socket.socketpair()
+    try:
+        assert server.handle_request(slow, _request('GetReport', 'big'))
+        busy = _reply(server, _request('GetReport', 'big'))
+        assert busy.exception.members['Message'] == 'Server is busy'
+        fast = _reply(server, _request('GetCompareInfo', 'en-US'))
+        assert fast.return_value.members['culture'] == 5
+    finally:
+        release.set()
+        slow_peer.close()
+
+
+def _run_in_order(executor, priorities):
+    release = threading.Event()
+    order = []
+    executor.submit(0, release.wait)
+    futures = [executor.submit(p, order.append, p) for p in priorities]
+    release.set()
+    for future in futures:
+        future.result()
+    return order
+
+
+def test_priority_executor_order():
+    order = _run_in_order(PriorityExecutor(max_workers=1), [2, 0, 1, 0])
+    assert order == [0, 0, 1, 2]
+
+
+def test_priority_executor_aging():
+    executor = PriorityExecutor(max_workers=1, aging=0.01)
+    release = threading.Event()
+    order = []
+    executor.submit(0, release.wait)
+    low = executor.submit(1, order.append, 'low')
+    time.sleep(0.05)
+    high = executor.submit(0, order.append, 'high')
+    release.set()
+    low.result()
+    high.result()
+    assert order == ['low', 'high']
+
+
+def test_dispatch_by_priority():
+    server = Server()
+    server.set_priority(0, methods=['GetCompareInfo'])
+    server.add_handler(Handler(GetCompareInfo))
+    sock, peer = socket.socketpair()
+    assert server.handle_request(sock, _request('GetCompareInfo', 'en-US'))
+    reply = decode_message(peer.recv(65536))
+    peer.close()
+    assert reply.return_value.members['culture'] == 5
+
+
+def test_handler_timeout():
+    release = threading.Event()
+    server = Server()
+    server.add_handler(
+        Handler(lambda name: release.wait(), method_name='GetReport', timeout=0.05)
+    )
+    try:
+        reply = _reply(server, _request('GetReport', 'big'))
+    finally:
+        release.set()
+    assert reply.exception.members['Message'] == 'Request timed out'
+    assert server.get_stats()['timeouts'] == 1
+
+
+def test_expired_request_is_not_run():
+    calls = []
+    server = Server()
+    handler = server.add_handler(Handler(calls.append, method_name='f'))
+    reply = server.run_handler(handler, None, deadline=time.time() - 1)
+    assert decode_message(reply).exception.members['Message'] == 'Request timed out'
+    assert calls == []
+
+
+def test_identical_requests_are_coalesced():
+    release = threading.Event()
+    calls = []
+
+    def GetCompareInfo(name):
+        calls.append(name)
+        release.wait()
+        return _compare_info(len(name))
+
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo, idempotent=True))
+    data = _request('GetCompareInfo', 'en-US')
+    executor = ThreadPoolExecutor(max_workers=4)
+    replies = [executor.submit(_reply, server, data) for _ in range(4)]
+    while server.get_stats()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for reply in replies:
+        assert reply.result().return_value.members['culture'] == 5
+    assert calls == ['en-US']
+
+
+def test_reply_cache():
+    calls = []
+
+    def GetCompareInfo(name):
+        calls.append(name)
+        return _compare_info(len(name))
+
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo, reply_cache=LRUCache(ttl=60)))
+    for name in ('en-US', 'en-US', 'fr', 'en-US'):
+        reply = _reply(server, _request('GetCompareInfo', name))
+        assert reply.return_value.members['culture'] == len(name)
+    assert calls == ['en-US', 'fr']
+    assert server.get_stats()['cached'] == 2
+    server.invalidate_replies(method_name='GetCompareInfo')
+    _reply(server, _request('GetCompareInfo', 'en-US'))
+    assert calls == ['en-US', 'fr', 'en-US']
@@ -0,0 +1,83 @@
+import os
+import signal
+import socket
+import time
+import pytest
+from msnrtp import RemotingMethod
+from msnrbf.enum import binary_type as bt
+from server import Server, Handler
+from supervisor import Supervisor
+from dotnetclient import ClientPool
+from test_server import _compare_info
+
+
+def GetCompareInfo(name):
+    return _compare_info(len(name))
+
+
+def _server():
+    server = Server()
+    server.add_handler(Handler(GetCompareInfo))
+    return server
+
+
+def _supervise_until(supervisor, condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        supervisor.supervise()
+
+
+def _alive(supervisor):
+    return all(process.is_alive() for process in supervisor.processes.values())
+
+
+@pytest.mark.parametrize('reuse_port', [True, False])
+def test_restart_worker(reuse_port):
+    supervisor = Supervisor(
+        _server, workers=2, reuse_port=reuse_port, stats_interval=0.05,
+        restart_delay=0
+    )
+    supervisor.start('127.0.0.1', 0)
+    try:
+        assert supervisor.port != 0
+        method = RemotingMethod(
+            'tcp://127.0.0.1:{}/Globalization.rem'.format(supervisor.port),
+            'Globalization.ICultureQuery, Globalization.Client',
+            'GetCompareInfo', [(bt.STRING, None)], None, idempotent=True
+        )
+        # Workers binding with SO_REUSEPORT may not be listening yet
+        _supervise_until(supervisor, lambda: len(supervisor._stats) == 2)
+        pool = ClientPool('127.0.0.1', supervisor.port, timeout=5)
+        try:
+            for name in ('en-US', 'fr-FR', 'de'):
+                reply = pool.call(method, [name])
+                assert reply.return_value.members['culture'] == len(name)
+        finally:
+            pool.close()
+        _supervise_until(
+            supervisor, lambda: supervisor.stats().get('requests') == 3
+        )
+        killed = supervisor.processes[0]
+        killed_stats = supervisor._stats[killed.pid]
+        os.kill(killed.pid, signal.SIGKILL)
+        _supervise_until(
+            supervisor,
+            lambda: supervisor.processes[0] is not killed and _alive(supervisor)
+        )
+        assert killed.pid not in supervisor._pids
+        assert supervisor._retired == killed_stats
+        assert supervisor.stats()['requests'] == 3
+    finally:
+        supervisor.stop()
+
+
+def test_listen_reuse_port():
+    first = Server().listen('127.0.0.1', 0, reuse_port=True)
+    try:
+        second = Server().listen('127.0.0.1', first.getsockname()[1], reuse_port=True)
+        second.close()
+        with pytest.raises(socket.error):
+            Server().listen('127.0.0.1', first.getsockname()[1])
+    finally:
+        first.close()